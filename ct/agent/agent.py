@@ -1,66 +1,238 @@
-
-from fastapi import FastAPI,APIRouter, Header, HTTPException, Request,Depends
+#!/usr/bin/env python3
+import os, json, time, random, socket, hashlib, platform, threading, asyncio, tempfile
+from fastapi import FastAPI, Header, HTTPException
 from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
-from controller.db.db import get_db
-import os
+from typing import Optional, Dict, Any
+import requests
+from requests.adapters import HTTPAdapter
+
+API_BASE = os.environ.get("API_BASE", "http://127.0.0.1:7604")
+AGENT_NAME = os.environ.get("AGENT_NAME", socket.gethostname())
+AGENT_HOST = os.environ.get("AGENT_HOST")
+AGENT_PORT = int(os.environ.get("AGENT_PORT", os.environ.get("DEFAULT_AGENT_PORT", 7614)))
+AGENT_TAGS = [t for t in os.environ.get("AGENT_TAGS", "").split(",") if t]
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 30))
+HEARTBEAT_JITTER = float(os.environ.get("HEARTBEAT_JITTER", 0.2))
+BACKOFF_BASE = float(os.environ.get("AGENT_BACKOFF_BASE", 2))
+BACKOFF_MAX = float(os.environ.get("AGENT_BACKOFF_MAX", 300))
+REQUEST_TIMEOUT = float(os.environ.get("AGENT_REQUEST_TIMEOUT", 10))
 
 app = FastAPI(title="Orchestration Agent ")
 
-router = APIRouter()
-
-class AgentRegisterReq(BaseModel):
-    agent_name: str
-    reg_secret: str
-    host: Optional[str] = None
-    port: Optional[int] = None
-    capabilities: Optional[Dict[str, Any]] = None
-    metadata: Optional[Dict[str, Any]] = None
-
-class AgentHeartbeatReq(BaseModel):
-    agent_name: str
-    status: str = "online"
-    metadata: Optional[Dict[str, Any]] = None
-
-def require_admin(x_token: str) -> None:
-    db = get_db()
-    if not db.validate_token(x_token, required_roles=["admin"]):
-        raise HTTPException(status_code=401, detail="invalid admin token")
-
-@router.post("/register")
-def register_agent(body: AgentRegisterReq, request: Request):
-    reg_secret_env = os.environ.get("AGENT_REG_SECRET")
-    if not reg_secret_env or body.reg_secret != reg_secret_env:
-        raise HTTPException(status_code=403, detail="invalid reg_secret")
-
-    # Auto-fill host and port
-    auto_host = request.client.host
-    host = body.host or auto_host
-    port = body.port or int(os.environ.get("DEFAULT_AGENT_PORT", 7614))
-
-    db = get_db()
-    db.register_or_update_agent(
-        agent_name=body.agent_name,
-        host=host,
-        port=port,
-        capabilities=body.capabilities or {},
-        metadata=body.metadata or {},
-        status="online",
-    )
-    return {"ok": True, "resolved_host": host, "resolved_port": port}
-
-@router.post("/heartbeat")
-def heartbeat(body: AgentHeartbeatReq):
-    db = get_db()
-    db.heartbeat(
-        agent_name=body.agent_name,
-        status=body.status,
-        metadata=body.metadata or {},
-    )
-    return {"ok": True}
-
-@router.get("/", response_model=List[Dict[str, Any]])
-def list_agents(x_admin_token: str = Header(..., alias="X-ADMIN-TOKEN")):
-    require_admin(x_admin_token)
-    db = get_db()
-    return db.list_agents()
+# ============================
+#  SCHEMAS
+# ============================
+
+class ExecuteReq(BaseModel):
+    workflow_id: str
+    job_id: str
+    script_id: Optional[str] = ""
+    script: str
+    timeout_s: Optional[float] = None
+
+# ============================
+#  HELPERS
+# ============================
+
+def _agent_api_key() -> str:
+    key = os.environ.get("AGENT_API_KEY")
+    if key:
+        return key
+    key_file = os.path.join(os.path.dirname(__file__), "api.key")
+    if os.path.exists(key_file):
+        with open(key_file) as f:
+            return f.read().strip()
+    return ""
+
+def metadata_hash(metadata: Dict[str, Any]) -> str:
+    # Must match controller.db.db.metadata_hash.
+    canonical = json.dumps(metadata or {}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def collect_metadata() -> Dict[str, Any]:
+    # Only slow-changing facts: the controller rewrites stored metadata
+    # whenever its hash changes.
+    return {
+        "hostname": socket.gethostname(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+    }
+
+def collect_stats() -> Dict[str, Any]:
+    # Readings that change every beat; sent outside the hashed metadata.
+    stats = {}
+    if hasattr(os, "getloadavg"):
+        stats["loadavg"] = list(os.getloadavg())
+    return stats
+
+# ============================
+#  CONTROLLER CLIENT
+# ============================
+
+class AgentRuntime:
+    """
+    Registers with the controller once, then heartbeats every
+    HEARTBEAT_INTERVAL seconds (+/- HEARTBEAT_JITTER) over a single
+    keep-alive session. Failed or slow calls back off exponentially,
+    capped at AGENT_BACKOFF_MAX, so a struggling controller is not hammered.
+    """
+
+    def __init__(self, api_base: str = API_BASE, agent_name: str = AGENT_NAME,
+                 interval: float = HEARTBEAT_INTERVAL, jitter: float = HEARTBEAT_JITTER):
+        self.api_base = api_base.rstrip("/")
+        self.agent_name = agent_name
+        self.interval = interval
+        self.jitter = jitter
+        self.failures = 0
+        self.registered = False
+        # Metadata the controller last accepted; heartbeats send deltas against it.
+        self.acked_metadata = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.session = requests.Session()
+        # One controller, so one small pool of persistent connections.
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.headers["x_admin_token"] = os.environ.get("ADMIN_TOKEN", "")
+
+    def _post(self, path: str, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """POST to the controller; returns the JSON reply, or None on failure or slowness."""
+        started = time.monotonic()
+        try:
+            r = self.session.post(self.api_base + path, json=payload, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"❌ {path} failed: {e}")
+            return None
+        elapsed = time.monotonic() - started
+        if r.status_code != 200:
+            print(f"❌ {path} returned HTTP {r.status_code}: {r.text[:200]}")
+            return None
+        if elapsed > self.interval / 2:
+            # Answered, but the controller is struggling: slow down as well.
+            print(f"⚠️ {path} took {elapsed:.1f}s")
+            return None
+        return r.json()
+
+    def register(self) -> bool:
+        metadata = collect_metadata()
+        payload = {
+            "agent_name": self.agent_name,
+            "reg_secret": os.environ.get("AGENT_REG_SECRET", ""),
+            "host": AGENT_HOST,
+            "port": AGENT_PORT,
+            "capabilities": {"tags": AGENT_TAGS},
+            "metadata": metadata,
+        }
+        self.registered = self._post("/api/agents/register", payload) is not None
+        self.acked_metadata = metadata if self.registered else None
+        return self.registered
+
+    def heartbeat(self) -> bool:
+        metadata = collect_metadata()
+        payload = {"agent_name": self.agent_name, "status": "online", "stats": collect_stats()}
+        acked = self.acked_metadata
+        if acked is None:
+            payload["metadata"] = metadata
+        else:
+            payload["metadata_hash"] = metadata_hash(metadata)
+            payload["metadata_delta"] = {k: v for k, v in metadata.items() if k not in acked or acked[k] != v}
+            payload["metadata_removed"] = [k for k in acked if k not in metadata]
+        reply = self._post("/api/agents/heartbeat", payload)
+        if reply is None:
+            return False
+        # On resync the next beat carries the full metadata again.
+        self.acked_metadata = None if reply.get("resync") else metadata
+        return True
+
+    def next_delay(self) -> float:
+        if self.failures:
+            backoff = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (self.failures - 1)))
+            return backoff * random.uniform(0.5, 1.0)
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self):
+        # Splay the first call so a fleet restarted together doesn't
+        # register in the same second.
+        if self._stop.wait(random.uniform(0, self.interval)):
+            return
+        while not self._stop.is_set():
+            ok = self.heartbeat() if self.registered else self.register()
+            self.failures = 0 if ok else self.failures + 1
+            if self.failures >= 3:
+                # The controller may have lost us; register again once it answers.
+                self.registered = False
+            self._stop.wait(self.next_delay())
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="agent-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.session.close()
+
+runtime = AgentRuntime()
+
+@app.on_event("startup")
+async def startup_event():
+    runtime.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    runtime.stop()
+
+# ============================
+#  ROUTES
+# ============================
+
+@app.get("/health")
+async def health_check():
+    return {
+        "status": "running",
+        "agent_name": runtime.agent_name,
+        "registered": runtime.registered,
+        "failures": runtime.failures,
+    }
+
+@app.post("/execute")
+async def execute(body: ExecuteReq, x_agent_key: str = Header(..., convert_underscores=False)):
+    """
+    Run a script pushed by the controller's dispatcher and return its result.
+    """
+    expected = _agent_api_key()
+    if not expected or x_agent_key != expected:
+        raise HTTPException(status_code=401, detail="invalid agent key")
+    fd, path = tempfile.mkstemp(prefix=f"{body.workflow_id}-", suffix=".sh")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(body.script)
+        os.chmod(path, 0o700)
+        proc = await asyncio.create_subprocess_exec(
+            path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=body.timeout_s)
+        except asyncio.TimeoutError:
+            proc.kill()
+            stdout, stderr = await proc.communicate()
+            return {"returncode": -9, "stdout": stdout.decode(errors="replace"),
+                    "stderr": stderr.decode(errors="replace") + "timed out"}
+        return {
+            "returncode": proc.returncode,
+            "stdout": stdout.decode(errors="replace"),
+            "stderr": stderr.decode(errors="replace"),
+        }
+    finally:
+        os.unlink(path)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=AGENT_PORT, log_level="info")
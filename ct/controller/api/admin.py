@@ -0,0 +1,36 @@
+from fastapi import APIRouter, Depends
+from controller.depends import get_principal, require_role
+
+from pydantic import BaseModel
+from typing import Optional
+from controller.db.db import get_db
+
+router = APIRouter(
+prefix="/admin",
+tags=["admin"],
+dependencies=[Depends(get_principal)]
+)
+
+class ProfilingUpdate(BaseModel):
+    enabled: Optional[bool] = None
+    slow_ms: Optional[float] = None
+    reset: bool = False
+
+@router.get("/profiling")
+def get_profiling(principal: dict = Depends(get_principal)):
+    """
+    DB profiler state: per-method and per-statement timings (statements
+    sorted by total time) plus recent slow queries with their query plans.
+    """
+    require_role(principal, ["admin"], detail="invalid admin token")
+    return get_db().profiler.snapshot()
+
+@router.post("/profiling")
+def update_profiling(body: ProfilingUpdate, principal: dict = Depends(get_principal)):
+    """Turn profiling on/off, change the slow-query threshold, or clear collected stats."""
+    require_role(principal, ["admin"], detail="invalid admin token")
+    profiler = get_db().profiler
+    profiler.configure(enabled=body.enabled, slow_ms=body.slow_ms)
+    if body.reset:
+        profiler.reset()
+    return {"enabled": profiler.enabled, "slow_ms": profiler.slow_ms}
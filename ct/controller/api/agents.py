@@ -1,19 +1,27 @@
-from fastapi import FastAPI,APIRouter, Header, HTTPException, Request,Depends
-from controller.depends import require_admin
+from fastapi import FastAPI,APIRouter, Header, HTTPException, Request,Response,Depends
+from controller.depends import require_admin as require_admin_token, get_principal, require_role, check_batch_size
 from pydantic import BaseModel
 from typing import Optional, Dict, Any, List
 import os
 
 from controller.db.db import get_db   # adjust if your db path is different
+from controller.heartbeats import get_heartbeat_buffer
+from controller.liveness import get_liveness_tracker, LIVENESS_STATES
+from controller.db.db import metadata_hash
+from controller.conditional import not_modified
+from controller.fastjson import json_response
 
 agents_router = APIRouter()
 
 router = APIRouter(
 prefix="/agents",
 tags=["agents"],
-dependencies=[Depends(require_admin)]
 )
 
+# Agents authenticate with the shared ADMIN_TOKEN (plus reg_secret to
+# register); the read routes below take a per-user token via get_principal.
+AGENT_AUTH = [Depends(require_admin_token)]
+
 
 # ============================
 #  SCHEMAS
@@ -35,10 +43,33 @@ class AgentRegisterReq(BaseModel):
     metadata: Optional[Dict[str, Any]] = None
 
 
+class AgentRegisterItem(BaseModel):
+    agent_name: str
+    host: Optional[str] = None
+    port: Optional[int] = None
+    capabilities: Optional[Dict[str, Any]] = None
+    metadata: Optional[Dict[str, Any]] = None
+
+class AgentRegisterBatch(BaseModel):
+    reg_secret: str
+    agents: List[AgentRegisterItem]
+
+
 class AgentHeartbeatReq(BaseModel):
     agent_name: str
     status: str = "online"
     metadata: Optional[Dict[str, Any]] = None
+    # Delta protocol: hash of the agent's full metadata plus only what changed
+    # since the last accepted beat. Full metadata is sent again on resync.
+    metadata_hash: Optional[str] = None
+    metadata_delta: Optional[Dict[str, Any]] = None
+    metadata_removed: Optional[List[str]] = None
+    # Volatile readings such as loadavg: kept in memory for listings only,
+    # never hashed or written to the database.
+    stats: Optional[Dict[str, Any]] = None
+
+class AgentHeartbeatBatch(BaseModel):
+    heartbeats: List[AgentHeartbeatReq]
 
 
 
@@ -80,17 +111,52 @@ async def get_agents(x_admin_token: str = Header(...)):
 #  HELPERS
 # ============================
 
-def require_admin(x_token: str) -> None:
-    db = get_db()
-    if not db.validate_token(x_token, required_roles=["admin"]):
-        raise HTTPException(status_code=401, detail="invalid admin token")
+def require_admin(principal: dict) -> None:
+    require_role(principal, ["admin"], detail="invalid admin token")
+
+def check_reg_secret(reg_secret: str) -> None:
+    reg_secret_env = os.environ.get("AGENT_REG_SECRET")
+    if not reg_secret_env or reg_secret != reg_secret_env:
+        raise HTTPException(status_code=403, detail="invalid reg_secret")
+
+def default_agent_port() -> int:
+    return int(os.environ.get("DEFAULT_AGENT_PORT", 7614))
+
+def apply_heartbeat(body: AgentHeartbeatReq) -> bool:
+    """Record one heartbeat; returns True if the agent must resend full metadata."""
+    tracker = get_liveness_tracker()
+    stored, stored_hash = tracker.metadata(body.agent_name)
+    metadata, new_hash, resync = None, None, False
+    if body.metadata is not None or body.metadata_hash is None:
+        metadata = body.metadata or {}
+        new_hash = metadata_hash(metadata)
+    elif body.metadata_hash != stored_hash:
+        if stored is None:
+            resync = True
+        else:
+            metadata = dict(stored)
+            metadata.update(body.metadata_delta or {})
+            for key in body.metadata_removed or []:
+                metadata.pop(key, None)
+            new_hash = metadata_hash(metadata)
+            resync = new_hash != body.metadata_hash
+    if resync or new_hash == stored_hash:
+        metadata = None
+    beat = get_heartbeat_buffer().record(
+        agent_name=body.agent_name,
+        status=body.status,
+        metadata=metadata,
+        md_hash=new_hash,
+    )
+    tracker.beat(body.agent_name, *beat, stats=body.stats)
+    return resync
 
 
 # ============================
 #  ROUTES
 # ============================
 
-@router.post("/register")
+@router.post("/register", dependencies=AGENT_AUTH)
 def register_agent(body: AgentRegisterReq, request: Request):
     """
     Register new agent or update existing record.
@@ -99,20 +165,17 @@ def register_agent(body: AgentRegisterReq, request: Request):
     Port defaults to DEFAULT_AGENT_PORT or 7614.
     """
 
-    reg_secret_env = os.environ.get("AGENT_REG_SECRET")
-    if not reg_secret_env or body.reg_secret != reg_secret_env:
-        raise HTTPException(status_code=403, detail="invalid reg_secret")
+    check_reg_secret(body.reg_secret)
 
     # Auto-detect host if missing
     client_host = request.client.host
     resolved_host = body.host or client_host
 
     # Default port (fallback to env or default 7614)
-    default_port = int(os.environ.get("DEFAULT_AGENT_PORT", 7614))
-    resolved_port = body.port or default_port
+    resolved_port = body.port or default_agent_port()
 
     db = get_db()
-    db.register_or_update_agent(
+    noop = db.register_or_update_agent(
         agent_name=body.agent_name,
         host=resolved_host,
         port=resolved_port,
@@ -120,33 +183,128 @@ def register_agent(body: AgentRegisterReq, request: Request):
         metadata=body.metadata or {},
         status="online",
     )
+    get_liveness_tracker().register(
+        agent_name=body.agent_name,
+        host=resolved_host,
+        port=resolved_port,
+        capabilities=body.capabilities or {},
+        metadata=body.metadata or {},
+    )
 
     return {
         "ok": True,
         "resolved_host": resolved_host,
-        "resolved_port": resolved_port
+        "resolved_port": resolved_port,
+        "noop": noop,
     }
 
 
-@router.post("/heartbeat")
+@router.post("/register:batch", dependencies=AGENT_AUTH)
+def register_agents_batch(body: AgentRegisterBatch, request: Request):
+    """
+    Register many agents at once, e.g. from a relay agent fronting a rack.
+    reg_secret is checked once and all items are written in one
+    transaction; host/port default as in /register. Results are per item,
+    in request order, and a failing item does not affect the others.
+    """
+    check_reg_secret(body.reg_secret)
+    check_batch_size(body.agents)
+    items = [
+        {
+            "agent_name": a.agent_name,
+            "host": a.host or request.client.host,
+            "port": a.port or default_agent_port(),
+            "capabilities": a.capabilities or {},
+            "metadata": a.metadata or {},
+            "status": "online",
+        }
+        for a in body.agents
+    ]
+    outcomes = get_db().register_agents_many(items)
+    tracker = get_liveness_tracker()
+    results = []
+    for item, outcome in zip(items, outcomes):
+        if isinstance(outcome, Exception):
+            results.append({"agent_name": item["agent_name"], "ok": False, "error": str(outcome)})
+            continue
+        tracker.register(**item)
+        results.append({
+            "agent_name": item["agent_name"],
+            "ok": True,
+            "resolved_host": item["host"],
+            "resolved_port": item["port"],
+            "noop": outcome,
+        })
+    return {"results": results}
+
+
+@router.post("/heartbeat", dependencies=AGENT_AUTH)
 def heartbeat(body: AgentHeartbeatReq):
     """
     Update agent heartbeat timestamp + status.
+    Buffered in memory and written in batches by the heartbeat flusher.
+    Metadata is only rewritten when its hash changes. Agents may send just
+    metadata_hash + metadata_delta/metadata_removed; if applying the delta
+    does not reproduce the hash, the reply asks for a full resync.
     """
-    db = get_db()
-    db.heartbeat(
-        agent_name=body.agent_name,
-        status=body.status,
-        metadata=body.metadata or {},
-    )
-    return {"ok": True}
+    return {"ok": True, "resync": apply_heartbeat(body)}
+
+
+@router.post("/heartbeat:batch", dependencies=AGENT_AUTH)
+def heartbeat_batch(body: AgentHeartbeatBatch):
+    """
+    Heartbeats for many agents in one request, with the same per-item
+    semantics as /heartbeat. They go through the heartbeat buffer, whose
+    next flush writes them in a single transaction.
+    """
+    check_batch_size(body.heartbeats)
+    return {"results": [{"agent_name": hb.agent_name, "ok": True, "resync": apply_heartbeat(hb)}
+                        for hb in body.heartbeats]}
 
 
 @router.get("/", response_model=List[Dict[str, Any]])
-def list_agents(x_admin_token: str = Header(..., alias="x_admin_token")):
+def list_agents(request: Request, response: Response, status: Optional[str] = None,
+                principal: dict = Depends(get_principal)):
     """
     List all agents (admin authentication required).
+    Served from the in-memory liveness tracker; each row carries a derived
+    liveness of online/stale/offline, and ?status= filters on it.
+    capabilities and metadata are returned as parsed objects.
+    Unchanged polls with If-None-Match/If-Modified-Since get a 304.
     """
-    require_admin(x_admin_token)
-    db = get_db()
-    return db.list_agents()
+    require_admin(principal)
+    if status and status not in LIVENESS_STATES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(LIVENESS_STATES)}")
+    tracker = get_liveness_tracker()
+    etag, modified_at = tracker.etag(status)
+    cached = not_modified(request, response, etag, modified_at)
+    if cached is not None:
+        return cached
+    return json_response(tracker.list(status), response)
+
+
+def _split(value: Optional[str]) -> List[str]:
+    return [v for v in (value or "").split(",") if v]
+
+
+@router.get("/select")
+def select_agents(tags: Optional[str] = None, any_tags: Optional[str] = None,
+                  exclude_tags: Optional[str] = None, liveness: Optional[str] = None,
+                  principal: dict = Depends(get_principal)):
+    """
+    Preview a target selector: agents with all of ?tags=, at least one of
+    ?any_tags= and none of ?exclude_tags= (comma-separated), optionally
+    only those in ?liveness=.
+    """
+    require_admin(principal)
+    if liveness and liveness not in LIVENESS_STATES:
+        raise HTTPException(status_code=400, detail=f"liveness must be one of {', '.join(LIVENESS_STATES)}")
+    agents = get_liveness_tracker().select(_split(tags), _split(any_tags), _split(exclude_tags), liveness)
+    return {"agents": agents, "count": len(agents)}
+
+
+@router.get("/tags")
+def list_tags(principal: dict = Depends(get_principal)):
+    """Capability tags in use, with the number of agents carrying each."""
+    require_admin(principal)
+    return get_liveness_tracker().tags()
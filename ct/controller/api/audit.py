@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Depends
+from controller.depends import get_principal, require_role
+
+from typing import Optional
+from controller.db.db import get_db
+from controller.audit import get_audit_writer
+from controller.export import ndjson_response
+
+router = APIRouter(
+prefix="/audit",
+tags=["audit"],
+dependencies=[Depends(get_principal)]
+)
+
+@router.get("/export")
+def export_audit(since: Optional[str] = None, until: Optional[str] = None,
+                 principal: dict = Depends(get_principal)):
+    """
+    Audit history for all workflows as NDJSON, oldest first.
+    since/until are ISO timestamps (since inclusive, until exclusive).
+    """
+    require_role(principal, ["admin", "approver", "viewer"])
+    get_audit_writer().flush()
+    db = get_db()
+    return ndjson_response(db.iter_audit(since, until), "audit.ndjson")
@@ -1,14 +1,15 @@
-from fastapi import APIRouter, Header, HTTPException,Depends
-from controller.depends import require_admin
+from fastapi import APIRouter, HTTPException,Depends,Request,Response
+from controller.depends import get_principal, require_role
 
 from pydantic import BaseModel
 from typing import List, Optional
 from controller.db.db import get_db
+from controller.conditional import not_modified
 
 router = APIRouter(
 prefix="/scripts",
 tags=["scripts"],
-dependencies=[Depends(require_admin)]
+dependencies=[Depends(get_principal)]
 )
 
 
@@ -19,14 +20,12 @@ class ScriptCreate(BaseModel):
     allowed_tags: List[str] = []
     required_approval_levels: int = 1
 
-def require_admin(x_token: str) -> None:
-    db = get_db()
-    if not db.validate_token(x_token, required_roles=["admin"]):
-        raise HTTPException(status_code=401, detail="invalid admin token")
+def require_admin(principal: dict) -> None:
+    require_role(principal, ["admin"], detail="invalid admin token")
 
 @router.post("/")
-def add_script(body: ScriptCreate, x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_admin(x_admin_token)
+def add_script(body: ScriptCreate, principal: dict = Depends(get_principal)):
+    require_admin(principal)
     db = get_db()
     db.add_script(
         script_id=body.script_id,
@@ -38,14 +37,22 @@ def add_script(body: ScriptCreate, x_admin_token: str = Header(..., alias="x_adm
     return {"ok": True}
 
 @router.get("/")
-def list_scripts(x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_admin(x_admin_token)
+def list_scripts(request: Request, response: Response, principal: dict = Depends(get_principal)):
+    """
+    All scripts, served from the in-memory catalog.
+    Carries an ETag; send it back as If-None-Match to get a 304 when nothing changed.
+    """
+    require_admin(principal)
     db = get_db()
-    return db.list_scripts()
+    scripts, etag = db.scripts_snapshot()
+    cached = not_modified(request, response, etag)
+    if cached is not None:
+        return cached
+    return [dict(s) for s in scripts.values()]
 
 @router.get("/{script_id}")
-def get_script(script_id: str, x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_admin(x_admin_token)
+def get_script(script_id: str, principal: dict = Depends(get_principal)):
+    require_admin(principal)
     db = get_db()
     script = db.get_script(script_id)
     if not script:
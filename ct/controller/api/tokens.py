@@ -1,5 +1,5 @@
-from fastapi import APIRouter, Header, HTTPException,Depends
-from controller.depends import require_admin
+from fastapi import APIRouter, Depends
+from controller.depends import get_principal, require_role
 
 
 from pydantic import BaseModel
@@ -9,7 +9,7 @@ from controller.db.db import get_db
 router = APIRouter(
 prefix="/tokens",
 tags=["tokens"],
-dependencies=[Depends(require_admin)]
+dependencies=[Depends(get_principal)]
 )
 
 
@@ -26,14 +26,12 @@ class TokenOut(BaseModel):
     created_at: Optional[str]
     revoked: bool
 
-def require_admin(x_token: str) -> None:
-    db = get_db()
-    if not db.validate_token(x_token, required_roles=["admin"]):
-        raise HTTPException(status_code=401, detail="invalid admin token")
+def require_admin(principal: dict) -> None:
+    require_role(principal, ["admin"], detail="invalid admin token")
 
 @router.post("/", response_model=str)
-def create_token(body: TokenCreate, x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_admin(x_admin_token)
+def create_token(body: TokenCreate, principal: dict = Depends(get_principal)):
+    require_admin(principal)
     import secrets
     token_plain = secrets.token_urlsafe(32)
     db = get_db()
@@ -41,8 +39,8 @@ def create_token(body: TokenCreate, x_admin_token: str = Header(..., alias="x_ad
     return token_plain
 
 @router.get("/", response_model=List[TokenOut])
-def list_tokens(x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_admin(x_admin_token)
+def list_tokens(principal: dict = Depends(get_principal)):
+    require_admin(principal)
     db = get_db()
     tokens = db.list_tokens()
     return [
@@ -57,8 +55,8 @@ def list_tokens(x_admin_token: str = Header(..., alias="x_admin_token")):
     ]
 
 @router.post("/{token_name}/revoke")
-def revoke_token(token_name: str, x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_admin(x_admin_token)
+def revoke_token(token_name: str, principal: dict = Depends(get_principal)):
+    require_admin(principal)
     db = get_db()
     db.revoke_token(token_name)
     return {"ok": True}
@@ -1,22 +1,39 @@
-import secrets, datetime, json, os, subprocess
-from controller.depends import require_admin
+import secrets, datetime, json, os, re
+from controller.depends import get_principal, require_role, check_batch_size
 
-from fastapi import APIRouter, Header, HTTPException,Depends
+from fastapi import APIRouter, Header, HTTPException,Depends,Request,Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from controller.db.db import get_db
+from controller.jobs import get_job_engine, job_summary, JobQueueFull
+from controller.audit import get_audit_writer
+from controller.export import ndjson_response
+from controller.conditional import not_modified
+from controller.fastjson import json_response, decode_json
+from controller.liveness import get_liveness_tracker, LIVENESS_STATES
 
 router = APIRouter(
 prefix="/workflows",
 tags=["workflow"],
-dependencies=[Depends(require_admin)]
+dependencies=[Depends(get_principal)]
 )
 
 
 
+class TargetSelector(BaseModel):
+    # Agents with every tag in tags, at least one of any_tags and none of
+    # exclude_tags. script_tags adds the script's allowed_tags to any_tags.
+    tags: List[str] = []
+    any_tags: List[str] = []
+    exclude_tags: List[str] = []
+    script_tags: bool = False
+    liveness: Optional[str] = None
+
 class WorkflowCreate(BaseModel):
     script_id: str
-    targets: List[str]
+    targets: List[str] = []
+    selector: Optional[TargetSelector] = None
     required_approval_levels: int = 1
     notify_email: Optional[str] = None
     ttl_minutes: int = 60
@@ -26,87 +43,211 @@ class WorkflowCreate(BaseModel):
 class WorkflowApprove(BaseModel):
     note: Optional[str] = ""
 
-def require_role(x_token: str, roles: List[str]) -> str:
-    db = get_db()
-    if not db.validate_token(x_token, required_roles=roles):
-        raise HTTPException(status_code=401, detail="invalid token")
-    return "token-user"
+class WorkflowBatchDecision(BaseModel):
+    workflow_ids: List[str]
+    note: Optional[str] = ""
+
+class WorkflowExecute(BaseModel):
+    max_parallel: Optional[int] = None
+    timeout_s: Optional[float] = None
+
+# API names for the JSON columns, which responses embed already parsed.
+_JSON_COLUMNS = {"targets": "targets_json", "approvals": "approvals_json"}
+
+def _workflow_out(row: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(row)
+    for name, column in _JSON_COLUMNS.items():
+        if column in out:
+            out[name] = decode_json(out.pop(column), "[]")
+    return out
+
+def _select_targets(sel: TargetSelector, script: Dict[str, Any]) -> List[str]:
+    if sel.liveness and sel.liveness not in LIVENESS_STATES:
+        raise HTTPException(status_code=400, detail=f"liveness must be one of {', '.join(LIVENESS_STATES)}")
+    any_tags = list(sel.any_tags)
+    if sel.script_tags:
+        allowed = decode_json(script.get("allowed_tags_json"), "[]") or []
+        if not allowed:
+            raise HTTPException(status_code=400, detail="script has no allowed_tags")
+        any_tags += allowed
+    if not (sel.tags or any_tags or sel.exclude_tags or sel.liveness):
+        raise HTTPException(status_code=400, detail="empty selector")
+    return get_liveness_tracker().select(sel.tags, any_tags, sel.exclude_tags, sel.liveness)
 
 @router.post("/")
-def create_workflow(body: WorkflowCreate, x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_role(x_admin_token, ["admin", "requestor"])
+def create_workflow(body: WorkflowCreate, principal: dict = Depends(get_principal)):
+    """
+    Create a pending workflow. Targets are the explicit targets plus any
+    agents matched by selector, resolved now and stored as a fixed list.
+    """
+    require_role(principal, ["admin", "requestor"])
     db = get_db()
     script = db.get_script(body.script_id)
     if not script:
         raise HTTPException(status_code=400, detail="unknown script_id")
+    targets = list(body.targets)
+    if body.selector is not None:
+        selected = _select_targets(body.selector, script)
+        if not selected:
+            raise HTTPException(status_code=400, detail="selector matched no agents")
+        targets = list(dict.fromkeys(targets + selected))
     wid = secrets.token_urlsafe(16)
     db.create_workflow(
         workflow_id=wid,
         script_id=body.script_id,
-        targets=body.targets,
+        targets=targets,
         requestor=body.requestor,
         required_levels=body.required_approval_levels,
         notify_email=body.notify_email or "",
         ttl_minutes=body.ttl_minutes,
         reason=body.reason,
     )
-    db.add_audit(wid, "created", body.requestor, note=body.reason)
-    return {"workflow_id": wid}
+    get_audit_writer().record(wid, "created", body.requestor, note=body.reason)
+    return {"workflow_id": wid, "targets": targets}
 
 @router.get("/")
-def list_workflows(limit: int = 100, x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_role(x_admin_token, ["admin", "approver", "viewer"])
+def list_workflows(request: Request, response: Response, limit: int = 100, after: Optional[str] = None,
+                   status: Optional[str] = None, script_id: Optional[str] = None,
+                   requestor: Optional[str] = None, since: Optional[str] = None,
+                   until: Optional[str] = None, fields: Optional[str] = None,
+                   principal: dict = Depends(get_principal)):
+    """
+    Newest-first workflows, filtered server-side.
+    Pass the X-Next-Cursor header of a page as ?after= to fetch the next one.
+    status and fields take comma-separated lists; targets and approvals
+    come back as parsed JSON.
+    Unchanged polls with If-None-Match/If-Modified-Since get a 304.
+    """
+    require_role(principal, ["admin", "approver", "viewer"])
+    db = get_db()
+    # Taken before querying so the ETag is never newer than the rows.
+    version = db.workflows_version
+    etag, modified_at = version.etag(request.url.query), version.modified_at
+    cached = not_modified(request, response, etag, modified_at)
+    if cached is not None:
+        return cached
+    limit = max(1, min(limit, 1000))
+    cursor = None
+    if after:
+        created_at, _, workflow_id = after.partition(",")
+        if not workflow_id:
+            raise HTTPException(status_code=400, detail="after must be <created_at>,<workflow_id>")
+        cursor = (created_at, workflow_id)
+    try:
+        rows = db.list_workflows(
+            limit,
+            after=cursor,
+            status=status.split(",") if status else None,
+            script_id=script_id,
+            requestor=requestor,
+            created_from=since,
+            created_to=until,
+            fields=[_JSON_COLUMNS.get(f, f) for f in fields.split(",")] if fields else None,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = f"{rows[-1]['created_at']},{rows[-1]['workflow_id']}"
+    return json_response([_workflow_out(r) for r in rows], response)
+
+@router.get("/export")
+def export_workflows(since: Optional[str] = None, until: Optional[str] = None,
+                     status: Optional[str] = None, principal: dict = Depends(get_principal)):
+    """
+    All workflows as NDJSON, oldest first; since/until filter on created_at.
+    Declared before /{workflow_id} so "export" is not taken as an id.
+    """
+    require_role(principal, ["admin", "approver", "viewer"])
+    db = get_db()
+    batches = db.iter_workflows(since, until, status)
+    return ndjson_response(([_workflow_out(r) for r in rows] for rows in batches), "workflows.ndjson")
+
+def _batch_results(workflow_ids: List[str], outcomes: List[Any]) -> Dict[str, Any]:
+    results = []
+    for wid, outcome in zip(workflow_ids, outcomes):
+        if isinstance(outcome, LookupError):
+            results.append({"workflow_id": wid, "ok": False, "error": "not found"})
+        elif isinstance(outcome, Exception):
+            results.append({"workflow_id": wid, "ok": False, "error": str(outcome)})
+        else:
+            results.append(dict(outcome or {}, workflow_id=wid, ok=True))
+    return {"results": results}
+
+@router.post("/approve:batch")
+def approve_workflows_batch(body: WorkflowBatchDecision, principal: dict = Depends(get_principal)):
+    """
+    Approve many workflows in one transaction, e.g. clearing a queue.
+    Results are per workflow, in request order; one that can't be
+    approved is reported and doesn't affect the others.
+    """
+    actor = require_role(principal, ["admin", "approver"])
+    check_batch_size(body.workflow_ids)
     db = get_db()
-    return db.list_workflows(limit)
+    outcomes = db.approve_workflows_many(body.workflow_ids, actor, 1, note=body.note or "")
+    return _batch_results(body.workflow_ids, outcomes)
+
+@router.post("/deny:batch")
+def deny_workflows_batch(body: WorkflowBatchDecision, principal: dict = Depends(get_principal)):
+    """Deny many workflows in one transaction; per-workflow results as for approve:batch."""
+    actor = require_role(principal, ["admin", "approver"])
+    check_batch_size(body.workflow_ids)
+    db = get_db()
+    outcomes = db.deny_workflows_many(body.workflow_ids, actor, note=body.note or "")
+    return _batch_results(body.workflow_ids, outcomes)
 
 @router.get("/{workflow_id}")
-def get_workflow(workflow_id: str, x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_role(x_admin_token, ["admin", "approver", "viewer"])
+def get_workflow(workflow_id: str, principal: dict = Depends(get_principal)):
+    require_role(principal, ["admin", "approver", "viewer"])
     db = get_db()
     wf = db.get_workflow(workflow_id)
     if not wf:
         raise HTTPException(status_code=404, detail="not found")
-    return wf
+    return json_response(_workflow_out(wf))
 
 @router.get("/{workflow_id}/audit")
-def get_audit(workflow_id: str, x_admin_token: str = Header(..., alias="x_admin_token")):
-    require_role(x_admin_token, ["admin", "approver", "viewer"])
+def get_audit(workflow_id: str, principal: dict = Depends(get_principal)):
+    require_role(principal, ["admin", "approver", "viewer"])
+    # Read-your-writes: push out anything still queued before reading.
+    get_audit_writer().flush()
     db = get_db()
     return {"audit": db.get_audit(workflow_id)}
 
 @router.post("/{workflow_id}/approve")
-def approve_workflow(workflow_id: str, body: WorkflowApprove, x_admin_token: str = Header(..., alias="x_admin_token")):
-    actor = require_role(x_admin_token, ["admin", "approver"])
+def approve_workflow(workflow_id: str, body: WorkflowApprove, principal: dict = Depends(get_principal)):
+    actor = require_role(principal, ["admin", "approver"])
     db = get_db()
-    wf = db.get_workflow(workflow_id)
-    if not wf:
+    try:
+        result = db.approve_workflow(workflow_id, actor, 1, note=body.note or "")
+    except LookupError:
         raise HTTPException(status_code=404, detail="not found")
-    if wf["status"] not in ("pending", "approved"):
-        raise HTTPException(status_code=400, detail=f"cannot approve in status {wf['status']}")
-    db.add_approval(workflow_id, actor, 1)
-    db.add_audit(workflow_id, "approved", actor, note=body.note or "")
-    wf = db.get_workflow(workflow_id)
-    approvals = len(json.loads(wf.get("approvals_json") or "[]"))
-    if approvals >= int(wf["required_approval_levels"] or 1):
-        db.update_workflow_status(workflow_id, "approved")
-    return {"ok": True, "approvals": approvals}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"ok": True, "approvals": result["approvals"], "status": result["status"],
+            "already_approved": result["already_approved"]}
 
 @router.post("/{workflow_id}/deny")
-def deny_workflow(workflow_id: str, body: WorkflowApprove, x_admin_token: str = Header(..., alias="x_admin_token")):
-    actor = require_role(x_admin_token, ["admin", "approver"])
+def deny_workflow(workflow_id: str, body: WorkflowApprove, principal: dict = Depends(get_principal)):
+    actor = require_role(principal, ["admin", "approver"])
     db = get_db()
-    wf = db.get_workflow(workflow_id)
-    if not wf:
+    try:
+        db.deny_workflow(workflow_id, actor, note=body.note or "")
+    except LookupError:
         raise HTTPException(status_code=404, detail="not found")
-    if wf["status"] not in ("pending", "approved"):
-        raise HTTPException(status_code=400, detail=f"cannot deny in status {wf['status']}")
-    db.update_workflow_status(workflow_id, "denied")
-    db.add_audit(workflow_id, "denied", actor, note=body.note or "")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"ok": True}
 
 @router.post("/{workflow_id}/execute")
-def execute_workflow(workflow_id: str, x_admin_token: str = Header(..., alias="x_admin_token")):
-    actor = require_role(x_admin_token, ["admin"])
+def execute_workflow(workflow_id: str, body: Optional[WorkflowExecute] = None,
+                     principal: dict = Depends(get_principal)):
+    """
+    Queue the workflow's script on the job engine and return the job id.
+    With targets, the script is sent to each target agent in parallel
+    (body.max_parallel at a time, body.timeout_s per target); without
+    targets it runs on the controller host.
+    Poll /workflows/{workflow_id}/executions/{job_id} for progress and results.
+    """
+    actor = require_role(principal, ["admin"])
     db = get_db()
     wf = db.get_workflow(workflow_id)
     if not wf:
@@ -115,8 +256,7 @@ def execute_workflow(workflow_id: str, x_admin_token: str = Header(..., alias="x
         raise HTTPException(status_code=400, detail="workflow not approved")
     now = datetime.datetime.utcnow().isoformat() + "Z"
     if wf.get("expires_at") and now > wf["expires_at"]:
-        db.update_workflow_status(workflow_id, "expired")
-        db.add_audit(workflow_id, "expired", actor, note="TTL expired")
+        # The expiry sweeper records the status change and audit row.
         raise HTTPException(status_code=400, detail="workflow expired")
     script = db.get_script(wf["script_id"])
     if not script:
@@ -124,24 +264,76 @@ def execute_workflow(workflow_id: str, x_admin_token: str = Header(..., alias="x
     script_path = script["script_file"]
     if not os.path.isabs(script_path):
         script_path = os.path.join(os.getcwd(), script_path)
+    targets = json.loads(wf.get("targets_json") or "[]")
+    # Claim before queueing: a second execute can't win the same workflow,
+    # and a fast job can't finish before "running" is written.
+    if not db.transition_workflow(workflow_id, "approved", "running"):
+        raise HTTPException(status_code=409, detail="workflow not approved or already executing")
     try:
-        result = subprocess.run(
-            [script_path],
-            capture_output=True,
-            text=True,
-            check=False,
+        job = get_job_engine().submit(
+            workflow_id, script_path, actor, targets,
+            script_id=wf["script_id"],
+            max_parallel=body.max_parallel if body else None,
+            timeout_s=body.timeout_s if body else None,
         )
-        status = "success" if result.returncode == 0 else "failed"
     except Exception as e:
-        status = "failed"
-        result = type("Obj", (), {"returncode": -1, "stdout": "", "stderr": str(e)})
-    db.update_workflow_status(workflow_id, status)
-    db.add_audit(workflow_id, "executed", actor, note=f"rc={result.returncode}")
-    targets = json.loads(wf.get("targets_json") or "[]")
-    return {
-        "status": status,
-        "returncode": result.returncode,
-        "stdout": result.stdout,
-        "stderr": result.stderr,
-        "targets": targets,
-    }
+        # Not queued after all: hand the workflow back.
+        db.transition_workflow(workflow_id, "running", "approved")
+        if isinstance(e, JobQueueFull):
+            raise HTTPException(status_code=503, detail="job queue full")
+        raise
+    get_audit_writer().record(workflow_id, "queued", actor, note=f"job={job['job_id']}")
+    return {"job_id": job["job_id"], "status": job["status"], "targets": targets}
+
+@router.get("/{workflow_id}/executions")
+def list_executions(workflow_id: str, principal: dict = Depends(get_principal)):
+    require_role(principal, ["admin", "approver", "viewer"])
+    return {"executions": [job_summary(j) for j in get_job_engine().list_for_workflow(workflow_id)]}
+
+@router.get("/{workflow_id}/executions/{job_id}")
+def get_execution(workflow_id: str, job_id: str, principal: dict = Depends(get_principal)):
+    """
+    Job status and progress; stdout/stderr are included once the job has finished.
+    """
+    require_role(principal, ["admin", "approver", "viewer"])
+    job = get_job_engine().get(job_id)
+    if not job or job["workflow_id"] != workflow_id:
+        raise HTTPException(status_code=404, detail="not found")
+    return job_summary(job, include_output=job["finished_at"] is not None)
+
+# Any of these ends a line in an SSE stream.
+_SSE_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+def _sse_data(text: str) -> str:
+    # One data: field per segment, so a \r from progress-bar output can't
+    # end the field early; clients join the fields back with \n.
+    return "".join(f"data: {part}\n" for part in _SSE_LINE_BREAK.split(text))
+
+@router.get("/{workflow_id}/executions/{job_id}/stream")
+async def stream_execution(workflow_id: str, job_id: str, offset: int = 0,
+                           last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+                           principal: dict = Depends(get_principal)):
+    """
+    Server-Sent Events feed of a job's output, one event per line.
+    Event ids are line offsets: reconnect with ?offset=N or Last-Event-ID to resume.
+    Lines are only pulled from the job buffer as fast as the client reads them.
+    """
+    require_role(principal, ["admin", "approver", "viewer"])
+    engine = get_job_engine()
+    job = engine.get(job_id)
+    if not job or job["workflow_id"] != workflow_id:
+        raise HTTPException(status_code=404, detail="not found")
+    if last_event_id and last_event_id.isdigit():
+        offset = int(last_event_id) + 1
+
+    async def events():
+        async for line_no, stream, text in engine.follow(job, offset):
+            yield f"id: {line_no}\nevent: {stream}\n{_sse_data(text)}\n"
+        end = {"status": job["status"], "returncode": job["returncode"]}
+        yield f"event: end\ndata: {json.dumps(end)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
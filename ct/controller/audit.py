@@ -0,0 +1,93 @@
+import os, datetime, threading
+from controller.db.db import DB, get_db
+
+AUDIT_FLUSH_MS = int(os.environ.get("AUDIT_FLUSH_MS", 200))
+AUDIT_MAX_BATCH = int(os.environ.get("AUDIT_MAX_BATCH", 500))
+# Actions that must be on disk before the request returns.
+AUDIT_SYNC_ACTIONS = set(a for a in os.environ.get("AUDIT_SYNC_ACTIONS", "").split(",") if a)
+
+class AuditWriter:
+    """
+    Append-only write-behind queue for workflow_audit rows.
+    Routes enqueue events; a writer thread inserts them in batches of up to
+    AUDIT_MAX_BATCH rows per transaction every AUDIT_FLUSH_MS. The timestamp
+    is taken at enqueue time so ordering by ts is unaffected.
+    """
+
+    def __init__(self, db: DB, flush_ms: int = AUDIT_FLUSH_MS, max_batch: int = AUDIT_MAX_BATCH):
+        self.db = db
+        self.flush_ms = flush_ms
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._queue = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"enqueued": 0, "sync": 0, "flushes": 0, "flushed_rows": 0, "errors": 0}
+
+    def record(self, workflow_id: str, action: str, actor: str, note: str = "", sync: bool = False):
+        if sync or action in AUDIT_SYNC_ACTIONS:
+            self.db.add_audit(workflow_id, action, actor, note)
+            with self._lock:
+                self.stats["sync"] += 1
+            return
+        ts = datetime.datetime.utcnow().isoformat() + "Z"
+        with self._lock:
+            self._queue.append((workflow_id, action, actor, ts, note))
+            self.stats["enqueued"] += 1
+            full = len(self._queue) >= self.max_batch
+        if full:
+            self._wake.set()
+
+    def flush(self) -> int:
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = self._queue[:self.max_batch]
+                    del self._queue[:len(batch)]
+                if not batch:
+                    return written
+                try:
+                    self.db.add_audit_many(batch)
+                except Exception as e:
+                    print(f"❌ Audit flush failed ({len(batch)} rows): {e}")
+                    with self._lock:
+                        self._queue[:0] = batch
+                        self.stats["errors"] += 1
+                    return written
+                written += len(batch)
+                with self._lock:
+                    self.stats["flushes"] += 1
+                    self.stats["flushed_rows"] += len(batch)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._queue)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_ms / 1000.0)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+_writer_instance = AuditWriter(get_db())
+
+def get_audit_writer() -> AuditWriter:
+    return _writer_instance
@@ -0,0 +1,49 @@
+import email.utils
+from typing import Optional
+from fastapi import Request, Response
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match comparison (weak, as RFC 9110 requires for GET)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+def _not_modified_since(if_modified_since: Optional[str], last_modified: float) -> bool:
+    if not if_modified_since:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # HTTP dates have whole-second resolution.
+    return int(last_modified) <= since
+
+def not_modified(request: Request, response: Response, etag: str,
+                 last_modified: Optional[float] = None) -> Optional[Response]:
+    """
+    Set ETag (and Last-Modified, an epoch) on the response; return a bare
+    304 if the client already has this version, else None and the handler
+    builds the body as usual. If-None-Match wins over If-Modified-Since.
+    """
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        headers["Last-Modified"] = email.utils.formatdate(last_modified, usegmt=True)
+    response.headers.update(headers)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        fresh = etag_matches(if_none_match, etag)
+    else:
+        fresh = last_modified is not None and _not_modified_since(
+            request.headers.get("if-modified-since"), last_modified)
+    if fresh:
+        return Response(status_code=304, headers=headers)
+    return None
@@ -1,18 +1,29 @@
 #!/usr/bin/env python3
 import os
 import sys
-from fastapi import FastAPI
+import time
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
 # Fix Python path - add the current directory
 sys.path.append(os.path.dirname(__file__))
 
-app = FastAPI(title="Orchestration Controller", redirect_slashes=True)
+from controller.db.db import get_db
+from controller.heartbeats import get_heartbeat_buffer
+from controller.jobs import get_job_engine
+from controller.dispatch import get_dispatcher
+from controller.sweeper import get_expiry_sweeper
+from controller.liveness import get_liveness_tracker
+from controller.audit import get_audit_writer
+from controller import metrics
+from controller.fastjson import FastJSONResponse
 
-# Mount UI
-UI_DIR = os.path.join(os.path.dirname(__file__), "ui")
-app.mount("/", StaticFiles(directory=UI_DIR, html=True), name="ui")
+get_db().method_hooks.append(metrics.observe_db)
+
+app = FastAPI(title="Orchestration Controller", redirect_slashes=True,
+              default_response_class=FastJSONResponse)
 
 # Add CORS
 app.add_middleware(
@@ -23,43 +34,137 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    metrics.http_request_duration.observe(
+        time.perf_counter() - started,
+        request.method,
+        _route_label(request.scope),
+        str(response.status_code),
+    )
+    return response
+
+# Full template per included route. Newer FastAPI leaves the router's own,
+# un-prefixed route ("/agents/") in scope["route"]; older versions copy it
+# with the prefix already applied, so those paths are used as they are.
+_API_PREFIX = "/api"
+_route_paths = {}
+
+def _include_api(router):
+    app.include_router(router, prefix=_API_PREFIX)
+    for route in router.routes:
+        _route_paths[id(route)] = _API_PREFIX + route.path
+
+def _route_label(scope) -> str:
+    # Label by route template ("/api/agents/{agent_name}"), not the raw
+    # path, to keep series bounded. Routing records the matched route in
+    # the scope; requests that matched none are "unmatched".
+    route = scope.get("route")
+    path = _route_paths.get(id(route)) or getattr(route, "path", None)
+    if not path:
+        return "unmatched"
+    return scope.get("root_path", "") + path
+
 # Import routers - use direct imports since we fixed the path
 try:
     from api.agents import router as agents_router
-    app.include_router(agents_router, prefix="/api")
+    _include_api(agents_router)
     print("✅ Agents routes mounted")
 except Exception as e:
     print(f"❌ Agents router failed: {e}")
 
 try:
     from api.workflows import router as workflows_router
-    app.include_router(workflows_router, prefix="/api")
+    _include_api(workflows_router)
     print("✅ Workflows routes mounted")
 except Exception as e:
     print(f"❌ Workflows router failed: {e}")
 
 try:
     from api.scripts import router as scripts_router
-    app.include_router(scripts_router, prefix="/api")
+    _include_api(scripts_router)
     print("✅ Scripts routes mounted")
 except Exception as e:
     print(f"❌ Scripts router failed: {e}")
 
 try:
     from api.tokens import router as tokens_router
-    app.include_router(tokens_router, prefix="/api")
+    _include_api(tokens_router)
     print("✅ Tokens routes mounted")
 except Exception as e:
     print(f"❌ Tokens router failed: {e}")
 
+try:
+    from api.audit import router as audit_router
+    _include_api(audit_router)
+    print("✅ Audit routes mounted")
+except Exception as e:
+    print(f"❌ Audit router failed: {e}")
+
+try:
+    from api.admin import router as admin_router
+    _include_api(admin_router)
+    print("✅ Admin routes mounted")
+except Exception as e:
+    print(f"❌ Admin router failed: {e}")
+
 # Health check
 @app.get("/health")
 async def health_check():
-    return {"status": "running", "message": "Controller is working"}
+    db = get_db()
+    heartbeats = get_heartbeat_buffer()
+    return {
+        "status": "running",
+        "message": "Controller is working",
+        "db_pool": db.pool_stats(),
+        "token_cache": db.token_cache.stats(),
+        "script_catalog": db.script_catalog.stats(),
+        "heartbeats": dict(heartbeats.stats, pending=heartbeats.pending()),
+        "agents": get_liveness_tracker().counts(),
+        "jobs": get_job_engine().stats(),
+        "dispatch": get_dispatcher().stats(),
+        "expiry_sweeper": get_expiry_sweeper().stats,
+        "audit": dict(get_audit_writer().stats, pending=get_audit_writer().pending()),
+    }
+
+# Prometheus text exposition
+@app.get("/metrics")
+def metrics_endpoint():
+    heartbeats = get_heartbeat_buffer()
+    jobs = get_job_engine().stats()
+    lines = []
+    for metric in (metrics.http_request_duration, metrics.db_call_duration,
+                   metrics.db_call_errors, metrics.db_lock_errors, metrics.script_duration):
+        lines += metric.render()
+    lines += metrics.render_gauge("controller_agents", "Agents by derived liveness.", "liveness",
+                                  get_liveness_tracker().counts())
+    lines += metrics.render_gauge("controller_workflows", "Workflows by status.", "status",
+                                  get_db().count_workflows_by_status())
+    lines += metrics.render_gauge("controller_queue_depth", "Items waiting in in-process queues.", "queue", {
+        "heartbeats": heartbeats.pending(),
+        "audit": get_audit_writer().pending(),
+        "jobs_queued": jobs["queued"],
+        "jobs_running": jobs["running"],
+        "dispatch_in_flight": get_dispatcher().in_flight,
+    })
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+# Mount UI last: a mount at "/" matches every path, so anything
+# registered after it would never be reached.
+UI_DIR = os.path.join(os.path.dirname(__file__), "ui")
+app.mount("/", StaticFiles(directory=UI_DIR, html=True), name="ui")
 
 # Debug routes
 @app.on_event("startup")
 async def startup_event():
+    get_liveness_tracker().load(get_db().list_agents())
+    get_db().scripts_snapshot()
+    get_audit_writer().start()
+    get_heartbeat_buffer().start()
+    await get_job_engine().start()
+    get_expiry_sweeper().start()
     print("\n=== REGISTERED ROUTES ===")
     for route in app.routes:
         if hasattr(route, 'path'):
@@ -67,6 +172,14 @@ async def startup_event():
             print(f"{list(methods)} {route.path}")
     print("=========================\n")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    get_expiry_sweeper().stop()
+    await get_job_engine().stop()
+    get_audit_writer().stop()
+    get_heartbeat_buffer().stop()
+    get_db().close()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
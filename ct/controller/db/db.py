@@ -1,6 +1,180 @@
 #!/usr/bin/env python3
-import os, sqlite3, json, datetime, hashlib
+import os, sqlite3, json, datetime, hashlib, threading, time, functools, secrets, inspect
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import List, Optional, Dict, Any
+from controller.db.profiler import QueryProfiler, ProfiledConnection
+
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+DB_CACHED_STATEMENTS = int(os.environ.get("DB_CACHED_STATEMENTS", 256))
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", 30))
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 1024))
+TOKEN_CACHE_RECHECK = float(os.environ.get("TOKEN_CACHE_RECHECK", 1))
+SCRIPT_CATALOG_RECHECK = float(os.environ.get("SCRIPT_CATALOG_RECHECK", 5))
+
+# Ordered, idempotent schema steps: (version, description, [sql, ...]).
+# Append new steps with the next version number; never edit applied ones.
+MIGRATIONS = [
+    (1, "index workflow listings and expiry", [
+        "CREATE INDEX IF NOT EXISTS idx_workflows_created_at ON workflows (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_workflows_status_expires ON workflows (status, expires_at)",
+    ]),
+    (2, "index audit lookups by workflow", [
+        "CREATE INDEX IF NOT EXISTS idx_workflow_audit_wf_ts ON workflow_audit (workflow_id, ts)",
+    ]),
+    (3, "index token lookups by hash", [
+        "CREATE INDEX IF NOT EXISTS idx_tokens_hash ON tokens (token_hash)",
+    ]),
+    (4, "keyset index for workflow pagination", [
+        "CREATE INDEX IF NOT EXISTS idx_workflows_created_id ON workflows (created_at, workflow_id)",
+        "CREATE INDEX IF NOT EXISTS idx_workflows_status_created ON workflows (status, created_at, workflow_id)",
+        "DROP INDEX IF EXISTS idx_workflows_created_at",
+    ]),
+    (5, "move approvals into workflow_approvals", [
+        "CREATE TABLE IF NOT EXISTS workflow_approvals ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " workflow_id TEXT NOT NULL,"
+        " approver TEXT NOT NULL,"
+        " level INTEGER,"
+        " ts TEXT,"
+        " UNIQUE (workflow_id, approver))",
+        "INSERT OR IGNORE INTO workflow_approvals (workflow_id, approver, level, ts)"
+        " SELECT w.workflow_id, json_extract(a.value, '$.approver'),"
+        " json_extract(a.value, '$.level'), json_extract(a.value, '$.ts')"
+        " FROM workflows w, json_each(w.approvals_json) a"
+        " WHERE json_valid(w.approvals_json) AND json_extract(a.value, '$.approver') IS NOT NULL",
+    ]),
+    (6, "track agent metadata hash for delta heartbeats", [
+        "ALTER TABLE agents ADD COLUMN metadata_hash TEXT",
+    ]),
+    (7, "index audit by time for exports", [
+        "CREATE INDEX IF NOT EXISTS idx_workflow_audit_ts ON workflow_audit (ts)",
+    ]),
+]
+
+WORKFLOW_FIELDS = (
+    "workflow_id", "script_id", "targets_json", "requestor", "status",
+    "required_approval_levels", "approvals_json", "notify_email", "reason",
+    "created_at", "expires_at", "last_update",
+)
+
+def metadata_hash(metadata: Optional[Dict[str, Any]]) -> str:
+    """Content hash of agent metadata; agents compute the same value."""
+    canonical = json.dumps(metadata or {}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+class TokenCache:
+    """TTL + LRU map of token_hash -> principal. Only valid tokens are cached."""
+
+    def __init__(self, ttl: float = TOKEN_CACHE_TTL, maxsize: int = TOKEN_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token_hash: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            entry = self._entries.get(token_hash)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[token_hash]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token_hash)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token_hash: str, principal: Dict[str, str], generation: int):
+        with self._lock:
+            # Drop fills that raced with an invalidation.
+            if generation != self.generation:
+                return
+            self._entries[token_hash] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(token_hash)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+class CollectionVersion:
+    """
+    Change counter for one collection, used to answer unchanged polls with
+    304 without querying. Bump after the change is committed and read
+    before querying, so an ETag is never newer than the rows it describes.
+    The per-process boot id keeps ETags from a previous run from matching.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.value = 0
+        self.modified_at = time.time()
+        self._boot = secrets.token_hex(4)
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.value += 1
+            self.modified_at = time.time()
+
+    def etag(self, variant: str = "") -> str:
+        """ETag for this version; variant distinguishes query strings over the same collection."""
+        tag = "%s-%s-%d" % (self.name, self._boot, self.value)
+        if variant:
+            tag += "-" + hashlib.sha1(variant.encode()).hexdigest()[:12]
+        return '"%s"' % tag
+
+class ScriptCatalog:
+    """
+    Every script row keyed by script_id plus an ETag over the whole set.
+    Filled lazily from the DB and dropped wholesale on any change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scripts = None
+        self.etag = None
+        self.generation = 0
+        self.hits = 0
+        self.loads = 0
+
+    def get(self) -> Optional[tuple]:
+        with self._lock:
+            if self._scripts is None:
+                return None
+            self.hits += 1
+            return self._scripts, self.etag
+
+    def fill(self, rows: List[Dict[str, Any]], generation: int) -> tuple:
+        scripts = OrderedDict((r["script_id"], r) for r in rows)
+        canonical = json.dumps(rows, sort_keys=True, separators=(",", ":"))
+        etag = '"%s"' % hashlib.sha256(canonical.encode()).hexdigest()[:32]
+        with self._lock:
+            self.loads += 1
+            # Drop fills that raced with an invalidation.
+            if generation == self.generation:
+                self._scripts, self.etag = scripts, etag
+        return scripts, etag
+
+    def clear(self):
+        with self._lock:
+            self._scripts = None
+            self.etag = None
+            self.generation += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._scripts or ()), "loaded": self._scripts is not None,
+                    "hits": self.hits, "loads": self.loads}
 
 class DB:
     def __init__(self, path: str):
@@ -8,13 +182,73 @@ class DB:
         dir_name = os.path.dirname(path)
         if dir_name:
             os.makedirs(dir_name, exist_ok=True)
+        # One long-lived connection per thread; uvicorn's threadpool is bounded
+        # so this is effectively a bounded pool without checkout/return.
+        self._local = threading.local()
+        self._pool_lock = threading.Lock()
+        self._pool = []
+        self._stats = {"opened": 0, "reused": 0, "closed": 0}
+        self.token_cache = TokenCache()
+        # Callables invoked as hook(method_name, seconds, error) after every
+        # public DB method, error being the raised exception or None; used by
+        # the /metrics endpoint and the profiler.
+        self.method_hooks = []
+        self.profiler = QueryProfiler()
+        self.method_hooks.append(self.profiler.record_method)
+        self._token_fingerprint = None
+        self._token_checked_at = 0.0
+        self.script_catalog = ScriptCatalog()
+        self.workflows_version = CollectionVersion("workflows")
+        self._script_fingerprint = None
+        self._script_checked_at = 0.0
         self._init_db()
 
-    def _connect(self):
-        conn = sqlite3.connect(self.path)
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000.0,
+            cached_statements=DB_CACHED_STATEMENTS,
+            check_same_thread=False,
+            factory=ProfiledConnection,
+        )
+        conn.profiler = self.profiler
         conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        return conn
+
+    def _connect(self):
+        # Callers use "with self._connect() as conn:", which commits or rolls
+        # back but does not close, so the thread's connection stays open.
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            with self._pool_lock:
+                self._stats["reused"] += 1
+            return conn
+        conn = self._open()
+        self._local.conn = conn
+        with self._pool_lock:
+            self._pool.append(conn)
+            self._stats["opened"] += 1
         return conn
 
+    def close(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, []
+            for conn in pool:
+                conn.close()
+                self._stats["closed"] += 1
+        self._local = threading.local()
+
+    def pool_stats(self) -> Dict[str, Any]:
+        with self._pool_lock:
+            stats = dict(self._stats)
+            stats["open"] = len(self._pool)
+        stats["busy_timeout_ms"] = DB_BUSY_TIMEOUT_MS
+        stats["cached_statements"] = DB_CACHED_STATEMENTS
+        return stats
+
     def _init_db(self):
         with self._connect() as conn:
             c = conn.cursor()
@@ -70,6 +304,73 @@ class DB:
                 " note TEXT)"
             )
             conn.commit()
+        self._migrate()
+
+    def _migrate(self):
+        """
+        Apply MIGRATIONS newer than the recorded schema_version, in order.
+        Each step runs in its own BEGIN IMMEDIATE transaction so several
+        workers starting on the same file apply it exactly once.
+        """
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            " version INTEGER PRIMARY KEY,"
+            " description TEXT,"
+            " applied_at TEXT)"
+        )
+        conn.commit()
+        for version, description, statements in MIGRATIONS:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT 1 FROM schema_version WHERE version=?", (version,)).fetchone()
+                if row:
+                    conn.rollback()
+                    continue
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (?,?,?)",
+                    (version, description, datetime.datetime.utcnow().isoformat() + "Z"),
+                )
+                conn.commit()
+                print(f"✅ DB migration {version}: {description}")
+            except Exception:
+                conn.rollback()
+                raise
+
+    @contextmanager
+    def _immediate(self):
+        # Write transaction that takes the write lock up front, so the reads
+        # inside it cannot be invalidated by another writer before commit.
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _apply_each(self, c, items: List[Any], apply) -> List[Any]:
+        # Batch writes: one transaction, one savepoint per item. A failing
+        # item is undone on its own and its exception returned in place of
+        # a result; the rest still commit.
+        results = []
+        for item in items:
+            c.execute("SAVEPOINT batch_item")
+            try:
+                results.append(apply(item))
+            except (sqlite3.Error, LookupError, ValueError, TypeError) as e:
+                c.execute("ROLLBACK TO batch_item")
+                results.append(e)
+            c.execute("RELEASE batch_item")
+        return results
+
+    def schema_version(self) -> int:
+        with self._connect() as conn:
+            row = conn.execute("SELECT max(version) FROM schema_version").fetchone()
+            return row[0] or 0
 
     # Token methods
     def create_token(self, token_name: str, token_plain: str, role: str, description: str = ""):
@@ -83,12 +384,14 @@ class DB:
                 (token_name, h, role, description, now),
             )
             conn.commit()
+        self.token_cache.clear()
 
     def revoke_token(self, token_name: str):
         with self._connect() as conn:
             c = conn.cursor()
             c.execute("UPDATE tokens SET revoked=1 WHERE token_name=?", (token_name,))
             conn.commit()
+        self.token_cache.clear()
 
     def list_tokens(self):
         with self._connect() as conn:
@@ -96,45 +399,141 @@ class DB:
             c.execute("SELECT token_name, role, description, created_at, revoked FROM tokens")
             return [dict(r) for r in c.fetchall()]
 
-    def validate_token(self, token_plain: str, required_roles: Optional[List[str]] = None) -> bool:
+    def _check_token_changes(self):
+        # Other processes sharing the file can create/revoke tokens. At most
+        # once per TOKEN_CACHE_RECHECK seconds, look at PRAGMA data_version
+        # (bumped by commits from any other connection) and, only if it moved,
+        # compare a cheap fingerprint of the tokens table.
+        now = time.monotonic()
+        if now - self._token_checked_at < TOKEN_CACHE_RECHECK:
+            return
+        self._token_checked_at = now
+        conn = self._connect()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if getattr(self._local, "data_version", None) == version:
+            return
+        self._local.data_version = version
+        row = conn.execute(
+            "SELECT count(*), total(revoked), max(created_at) FROM tokens"
+        ).fetchone()
+        fingerprint = tuple(row)
+        if fingerprint != self._token_fingerprint:
+            self._token_fingerprint = fingerprint
+            self.token_cache.clear()
+
+    def resolve_principal(self, token_plain: str) -> Optional[Dict[str, str]]:
+        """Return {"actor": token_name, "role": role} for an active token, or None."""
         h = hashlib.sha256(token_plain.encode()).hexdigest()
+        self._check_token_changes()
+        principal = self.token_cache.get(h)
+        if principal is not None:
+            return dict(principal)
+        generation = self.token_cache.generation
         with self._connect() as conn:
             c = conn.cursor()
-            c.execute("SELECT role FROM tokens WHERE token_hash=? AND revoked=0", (h,))
+            c.execute("SELECT role, token_name FROM tokens WHERE token_hash=? AND revoked=0", (h,))
             row = c.fetchone()
-            if not row:
-                return False
-            role = row["role"]
-            if required_roles is None:
-                return True
-            return role in required_roles
+        if not row:
+            return None
+        principal = {"actor": row["token_name"], "role": row["role"]}
+        self.token_cache.put(h, principal, generation)
+        return dict(principal)
+
+    def resolve_token(self, token_plain: str) -> Optional[str]:
+        """Return the role of an active token, or None."""
+        principal = self.resolve_principal(token_plain)
+        return principal["role"] if principal else None
+
+    def validate_token(self, token_plain: str, required_roles: Optional[List[str]] = None) -> bool:
+        role = self.resolve_token(token_plain)
+        if role is None:
+            return False
+        if required_roles is None:
+            return True
+        return role in required_roles
 
     # Agents
     def register_or_update_agent(self, agent_name: str, host: str, port: int,
-                                 capabilities: Dict[str, Any], metadata: Dict[str, Any], status: str = "online"):
+                                 capabilities: Dict[str, Any], metadata: Dict[str, Any], status: str = "online") -> bool:
+        """
+        Upsert an agent. Returns True when the registration was a no-op:
+        host, port, status, capabilities and metadata all match the stored
+        row, in which case only last_seen is touched.
+        """
         now = datetime.datetime.utcnow().isoformat() + "Z"
-        with self._connect() as conn:
-            c = conn.cursor()
-            c.execute(
-                "REPLACE INTO agents (agent_name, host, port, status, capabilities_json, metadata_json, last_seen)"
-                " VALUES (?,?,?,?,?,?,?)",
-                (agent_name, host, port, status, json.dumps(capabilities or {}), json.dumps(metadata or {}), now),
-            )
-            conn.commit()
+        with self._immediate() as c:
+            return self._register_agent(c, agent_name, host, port, capabilities, metadata, status, now)
+
+    def register_agents_many(self, agents: List[Dict[str, Any]]) -> List[Any]:
+        """
+        register_or_update_agent for many agents in one transaction; each
+        item holds its keyword arguments. Returns, per item, the noop bool
+        or the exception that rolled back just that item.
+        """
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        with self._immediate() as c:
+            return self._apply_each(c, agents, lambda a: self._register_agent(c, now=now, **a))
+
+    def _register_agent(self, c, agent_name: str, host: str, port: int, capabilities: Dict[str, Any],
+                        metadata: Dict[str, Any], status: str = "online", now: str = "") -> bool:
+        capabilities_json = json.dumps(capabilities or {}, sort_keys=True)
+        md_hash = metadata_hash(metadata)
+        fingerprint = (host, port, status, capabilities_json, md_hash)
+        # Compare against the stored columns rather than a saved payload
+        # hash, so metadata changed by heartbeats since is accounted for.
+        c.execute(
+            "SELECT host, port, status, capabilities_json, metadata_hash FROM agents WHERE agent_name=?",
+            (agent_name,),
+        )
+        row = c.fetchone()
+        if row and tuple(row) == fingerprint:
+            c.execute("UPDATE agents SET last_seen=? WHERE agent_name=?", (now, agent_name))
+            return True
+        c.execute(
+            "INSERT INTO agents (agent_name, host, port, status, capabilities_json, metadata_json,"
+            " metadata_hash, last_seen) VALUES (?,?,?,?,?,?,?,?)"
+            " ON CONFLICT(agent_name) DO UPDATE SET"
+            " host=excluded.host, port=excluded.port, status=excluded.status,"
+            " capabilities_json=excluded.capabilities_json, metadata_json=excluded.metadata_json,"
+            " metadata_hash=excluded.metadata_hash, last_seen=excluded.last_seen",
+            (agent_name, host, port, status, capabilities_json, json.dumps(metadata or {}), md_hash, now),
+        )
+        return False
 
     def heartbeat(self, agent_name: str, status: str, metadata: Dict[str, Any]):
+        # One beat through heartbeat_many, so metadata_hash stays in step
+        # with metadata_json for _register_agent's no-op check.
         now = datetime.datetime.utcnow().isoformat() + "Z"
+        self.heartbeat_many([(agent_name, status, json.dumps(metadata or {}), now, metadata_hash(metadata))])
+
+    def heartbeat_many(self, beats: List[tuple]):
+        """
+        Apply (agent_name, status, metadata_json, last_seen, metadata_hash) rows
+        in one transaction. Unknown agents are inserted, matching heartbeat().
+        A metadata_json of None means the metadata is unchanged, so only
+        status and last_seen are written for that agent.
+        """
+        full = [b for b in beats if b[2] is not None]
+        light = [(b[0], b[1], b[3]) for b in beats if b[2] is None]
+        newer = " WHERE agents.last_seen IS NULL OR excluded.last_seen >= agents.last_seen"
         with self._connect() as conn:
             c = conn.cursor()
-            c.execute(
-                "UPDATE agents SET status=?, metadata_json=?, last_seen=? WHERE agent_name=?",
-                (status, json.dumps(metadata or {}), now, agent_name),
-            )
-            if c.rowcount == 0:
-                c.execute(
+            if full:
+                c.executemany(
+                    "INSERT INTO agents (agent_name, status, capabilities_json, metadata_json, last_seen, metadata_hash)"
+                    " VALUES (?,?,'{}',?,?,?)"
+                    " ON CONFLICT(agent_name) DO UPDATE SET"
+                    " status=excluded.status, metadata_json=excluded.metadata_json,"
+                    " last_seen=excluded.last_seen, metadata_hash=excluded.metadata_hash" + newer,
+                    full,
+                )
+            if light:
+                c.executemany(
                     "INSERT INTO agents (agent_name, status, capabilities_json, metadata_json, last_seen)"
-                    " VALUES (?,?,?,?,?)",
-                    (agent_name, status, "{}", json.dumps(metadata or {}), now),
+                    " VALUES (?,?,'{}','{}',?)"
+                    " ON CONFLICT(agent_name) DO UPDATE SET"
+                    " status=excluded.status, last_seen=excluded.last_seen" + newer,
+                    light,
                 )
             conn.commit()
 
@@ -144,6 +543,22 @@ class DB:
             c.execute("SELECT * FROM agents")
             return [dict(r) for r in c.fetchall()]
 
+    def get_agents(self, agent_names: List[str]) -> Dict[str, Dict[str, Any]]:
+        names = list(dict.fromkeys(agent_names))
+        found = {}
+        with self._connect() as conn:
+            c = conn.cursor()
+            # Stay well under SQLITE_MAX_VARIABLE_NUMBER on older builds.
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                c.execute(
+                    "SELECT * FROM agents WHERE agent_name IN (%s)" % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                for r in c.fetchall():
+                    found[r["agent_name"]] = dict(r)
+        return found
+
     # Scripts
     def add_script(self, script_id: str, script_file: str, description: str,
                    allowed_tags, required_approval_levels: int):
@@ -155,19 +570,55 @@ class DB:
                 (script_id, script_file, description, json.dumps(allowed_tags or []), required_approval_levels),
             )
             conn.commit()
+        self.script_catalog.clear()
 
-    def list_scripts(self):
+    def _check_script_changes(self):
+        # Same scheme as _check_token_changes: scripts added by another
+        # process are picked up within SCRIPT_CATALOG_RECHECK seconds.
+        # REPLACE gives the row a new rowid, so max(rowid) catches redefinitions.
+        now = time.monotonic()
+        if now - self._script_checked_at < SCRIPT_CATALOG_RECHECK:
+            return
+        self._script_checked_at = now
+        conn = self._connect()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if getattr(self._local, "script_data_version", None) == version:
+            return
+        self._local.script_data_version = version
+        row = conn.execute(
+            "SELECT count(*), max(rowid), total(length(script_file) + length(coalesce(description, ''))"
+            " + length(coalesce(allowed_tags_json, '')) + coalesce(required_approval_levels, 0)) FROM scripts"
+        ).fetchone()
+        fingerprint = tuple(row)
+        if fingerprint != self._script_fingerprint:
+            if self._script_fingerprint is not None:
+                self.script_catalog.clear()
+            self._script_fingerprint = fingerprint
+
+    def scripts_snapshot(self) -> tuple:
+        """
+        (scripts, etag) from the in-memory catalog, loading it if needed.
+        scripts maps script_id -> row; treat it as read-only.
+        """
+        self._check_script_changes()
+        cached = self.script_catalog.get()
+        if cached is not None:
+            return cached
+        generation = self.script_catalog.generation
         with self._connect() as conn:
             c = conn.cursor()
-            c.execute("SELECT * FROM scripts")
-            return [dict(r) for r in c.fetchall()]
+            c.execute("SELECT * FROM scripts ORDER BY rowid")
+            rows = [dict(r) for r in c.fetchall()]
+        return self.script_catalog.fill(rows, generation)
+
+    def list_scripts(self):
+        scripts, _ = self.scripts_snapshot()
+        return [dict(s) for s in scripts.values()]
 
     def get_script(self, script_id: str):
-        with self._connect() as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM scripts WHERE script_id=?", (script_id,))
-            row = c.fetchone()
-            return dict(row) if row else None
+        scripts, _ = self.scripts_snapshot()
+        script = scripts.get(script_id)
+        return dict(script) if script else None
 
     # Workflows
     def create_workflow(self, workflow_id: str, script_id: str, targets,
@@ -198,6 +649,7 @@ class DB:
                 ),
             )
             conn.commit()
+        self.workflows_version.bump()
 
     def get_workflow(self, workflow_id: str):
         with self._connect() as conn:
@@ -206,12 +658,107 @@ class DB:
             row = c.fetchone()
             return dict(row) if row else None
 
-    def list_workflows(self, limit: int = 100):
+    def list_workflows(self, limit: int = 100, after: Optional[tuple] = None,
+                       status: Optional[List[str]] = None, script_id: Optional[str] = None,
+                       requestor: Optional[str] = None, created_from: Optional[str] = None,
+                       created_to: Optional[str] = None, fields: Optional[List[str]] = None):
+        """
+        Newest-first page of workflows.
+        after is the (created_at, workflow_id) of the last row of the previous
+        page (keyset pagination). fields limits the returned columns;
+        workflow_id and created_at are always included for the cursor.
+        """
+        if fields:
+            unknown = set(fields) - set(WORKFLOW_FIELDS)
+            if unknown:
+                raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+            cols = [f for f in WORKFLOW_FIELDS if f in fields or f in ("workflow_id", "created_at")]
+            select = ", ".join(cols)
+        else:
+            select = "*"
+        where, params = [], []
+        if after:
+            where.append("(created_at, workflow_id) < (?, ?)")
+            params += [after[0], after[1]]
+        if status:
+            where.append("status IN (%s)" % ",".join("?" * len(status)))
+            params += list(status)
+        if script_id:
+            where.append("script_id = ?")
+            params.append(script_id)
+        if requestor:
+            where.append("requestor = ?")
+            params.append(requestor)
+        if created_from:
+            where.append("created_at >= ?")
+            params.append(created_from)
+        if created_to:
+            where.append("created_at < ?")
+            params.append(created_to)
+        sql = f"SELECT {select} FROM workflows"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at DESC, workflow_id DESC LIMIT ?"
+        params.append(limit)
         with self._connect() as conn:
             c = conn.cursor()
-            c.execute("SELECT * FROM workflows ORDER BY created_at DESC LIMIT ?", (limit,))
+            c.execute(sql, params)
             return [dict(r) for r in c.fetchall()]
 
+    def _iter_rows(self, sql: str, params: tuple, batch: int):
+        # Dedicated connection: the generator may be resumed on different
+        # threads, so it can't borrow a per-thread pooled connection.
+        conn = self._open()
+        try:
+            c = conn.execute(sql, params)
+            while True:
+                rows = c.fetchmany(batch)
+                if not rows:
+                    return
+                yield [dict(r) for r in rows]
+        finally:
+            conn.close()
+
+    def iter_workflows(self, since: Optional[str] = None, until: Optional[str] = None,
+                       status: Optional[str] = None, batch: int = 500):
+        """Yield lists of workflow rows, oldest first, without loading them all."""
+        where, params = [], []
+        if since:
+            where.append("created_at >= ?")
+            params.append(since)
+        if until:
+            where.append("created_at < ?")
+            params.append(until)
+        if status:
+            where.append("status = ?")
+            params.append(status)
+        sql = "SELECT * FROM workflows"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at, workflow_id"
+        return self._iter_rows(sql, tuple(params), batch)
+
+    def iter_audit(self, since: Optional[str] = None, until: Optional[str] = None, batch: int = 500):
+        """Yield lists of audit rows in time order, without loading them all."""
+        where, params = [], []
+        if since:
+            where.append("ts >= ?")
+            params.append(since)
+        if until:
+            where.append("ts < ?")
+            params.append(until)
+        sql = "SELECT id, workflow_id, action, actor, ts, note FROM workflow_audit"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts, id"
+        return self._iter_rows(sql, tuple(params), batch)
+
+    def count_workflows_by_status(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            c = conn.cursor()
+            c.execute("SELECT status, count(*) AS n FROM workflows GROUP BY status")
+            return {r["status"] or "": r["n"] for r in c.fetchall()}
+
     def update_workflow_status(self, workflow_id: str, status: str):
         now = datetime.datetime.utcnow().isoformat() + "Z"
         with self._connect() as conn:
@@ -221,39 +768,189 @@ class DB:
                 (status, now, workflow_id),
             )
             conn.commit()
+        self.workflows_version.bump()
 
-    def add_approval(self, workflow_id: str, approver: str, level: int):
-        wf = self.get_workflow(workflow_id)
-        if not wf:
-            return
-        approvals = json.loads(wf.get("approvals_json") or "[]")
-        if not any(a.get("approver") == approver for a in approvals):
-            approvals.append(
-                {
-                    "approver": approver,
-                    "level": level,
-                    "ts": datetime.datetime.utcnow().isoformat() + "Z",
-                }
-            )
+    def transition_workflow(self, workflow_id: str, from_status: str, to_status: str) -> bool:
+        """
+        Move a workflow from from_status to to_status in one conditional
+        UPDATE. Returns False if it was not in from_status (or is missing),
+        so concurrent callers can't both claim it.
+        """
+        now = datetime.datetime.utcnow().isoformat() + "Z"
         with self._connect() as conn:
             c = conn.cursor()
             c.execute(
-                "UPDATE workflows SET approvals_json=?, last_update=? WHERE workflow_id=?",
-                (json.dumps(approvals), datetime.datetime.utcnow().isoformat() + "Z", workflow_id),
+                "UPDATE workflows SET status=?, last_update=? WHERE workflow_id=? AND status=?",
+                (to_status, now, workflow_id, from_status),
             )
+            changed = c.rowcount == 1
             conn.commit()
+        if changed:
+            self.workflows_version.bump()
+        return changed
 
-    def add_audit(self, workflow_id: str, action: str, actor: str, note: str = ""):
-        ts = datetime.datetime.utcnow().isoformat() + "Z"
+    def cancel_running_workflows(self, actor: str, note: str) -> int:
+        """
+        Mark every "running" workflow cancelled, with one audit row each.
+        Used at startup: jobs live in memory, so anything still running was
+        lost with the previous process. Returns the number cancelled.
+        """
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        with self._immediate() as c:
+            c.execute(
+                "INSERT INTO workflow_audit (workflow_id, action, actor, ts, note)"
+                " SELECT workflow_id, 'cancelled', ?, ?, ? FROM workflows WHERE status='running'",
+                (actor, now, note),
+            )
+            c.execute(
+                "UPDATE workflows SET status='cancelled', last_update=? WHERE status='running'",
+                (now,),
+            )
+            cancelled = c.rowcount
+        if cancelled:
+            self.workflows_version.bump()
+        return cancelled
+
+    def expire_due_workflows(self, actor: str = "expiry-sweeper") -> int:
+        """
+        Expire every pending/approved workflow past its expires_at, with one
+        audit row each, in a single transaction. Returns the number expired.
+        """
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        due = "status IN ('pending', 'approved') AND expires_at < ?"
+        with self._immediate() as c:
+            c.execute(
+                "INSERT INTO workflow_audit (workflow_id, action, actor, ts, note)"
+                f" SELECT workflow_id, 'expired', ?, ?, 'TTL expired' FROM workflows WHERE {due}",
+                (actor, now, now),
+            )
+            c.execute(
+                f"UPDATE workflows SET status='expired', last_update=? WHERE {due}",
+                (now, now),
+            )
+            expired = c.rowcount
+        if expired:
+            self.workflows_version.bump()
+        return expired
+
+    def _decidable_workflow(self, c, workflow_id: str, verb: str):
+        c.execute(
+            "SELECT status, required_approval_levels FROM workflows WHERE workflow_id=?",
+            (workflow_id,),
+        )
+        row = c.fetchone()
+        if not row:
+            raise LookupError("not found")
+        if row["status"] not in ("pending", "approved"):
+            raise ValueError(f"cannot {verb} in status {row['status']}")
+        return row
+
+    def approve_workflow(self, workflow_id: str, approver: str, level: int = 1, note: str = "") -> Dict[str, Any]:
+        """
+        Record an approval, audit it and move the workflow to "approved" once
+        enough distinct approvers have signed off, all in one transaction.
+        Raises LookupError if the workflow is missing and ValueError if it
+        can no longer be approved.
+        """
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        with self._immediate() as c:
+            result = self._approve(c, workflow_id, approver, level, note, now)
+        self.workflows_version.bump()
+        return result
+
+    def approve_workflows_many(self, workflow_ids: List[str], approver: str, level: int = 1,
+                               note: str = "") -> List[Any]:
+        """
+        approve_workflow for many workflows in one transaction. Returns, per
+        workflow, its result dict or the LookupError/ValueError it raised.
+        """
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        with self._immediate() as c:
+            results = self._apply_each(c, workflow_ids, lambda w: self._approve(c, w, approver, level, note, now))
+        self.workflows_version.bump()
+        return results
+
+    def _approve(self, c, workflow_id: str, approver: str, level: int, note: str, now: str) -> Dict[str, Any]:
+        wf = self._decidable_workflow(c, workflow_id, "approve")
+        c.execute(
+            "INSERT OR IGNORE INTO workflow_approvals (workflow_id, approver, level, ts) VALUES (?,?,?,?)",
+            (workflow_id, approver, level, now),
+        )
+        if not c.rowcount:
+            # This approver already signed off: no new approval, no audit row.
+            c.execute("SELECT count(*) FROM workflow_approvals WHERE workflow_id=?", (workflow_id,))
+            return {"status": wf["status"], "approvals": c.fetchone()[0], "already_approved": True}
+        c.execute(
+            "SELECT approver, level, ts FROM workflow_approvals WHERE workflow_id=? ORDER BY id",
+            (workflow_id,),
+        )
+        approvals = [dict(r) for r in c.fetchall()]
+        status = wf["status"]
+        if len(approvals) >= int(wf["required_approval_levels"] or 1):
+            status = "approved"
+        # approvals_json stays as a denormalized copy for list/get responses.
+        c.execute(
+            "UPDATE workflows SET status=?, approvals_json=?, last_update=? WHERE workflow_id=?",
+            (status, json.dumps(approvals), now, workflow_id),
+        )
+        self._insert_audit(c, workflow_id, "approved", approver, note, now)
+        return {"status": status, "approvals": len(approvals), "already_approved": False}
+
+    def deny_workflow(self, workflow_id: str, actor: str, note: str = ""):
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        with self._immediate() as c:
+            self._deny(c, workflow_id, actor, note, now)
+        self.workflows_version.bump()
+
+    def deny_workflows_many(self, workflow_ids: List[str], actor: str, note: str = "") -> List[Any]:
+        """deny_workflow for many workflows in one transaction; per workflow, None or the error."""
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        with self._immediate() as c:
+            results = self._apply_each(c, workflow_ids, lambda w: self._deny(c, w, actor, note, now))
+        self.workflows_version.bump()
+        return results
+
+    def _deny(self, c, workflow_id: str, actor: str, note: str, now: str):
+        self._decidable_workflow(c, workflow_id, "deny")
+        c.execute(
+            "UPDATE workflows SET status='denied', last_update=? WHERE workflow_id=?",
+            (now, workflow_id),
+        )
+        self._insert_audit(c, workflow_id, "denied", actor, note, now)
+
+    def get_approvals(self, workflow_id: str):
         with self._connect() as conn:
             c = conn.cursor()
             c.execute(
+                "SELECT approver, level, ts FROM workflow_approvals WHERE workflow_id=? ORDER BY id",
+                (workflow_id,),
+            )
+            return [dict(r) for r in c.fetchall()]
+
+    def _insert_audit(self, c, workflow_id: str, action: str, actor: str, note: str, ts: str):
+        c.execute(
+            "INSERT INTO workflow_audit (workflow_id, action, actor, ts, note)"
+            " VALUES (?,?,?,?,?)",
+            (workflow_id, action, actor, ts, note),
+        )
+
+    def add_audit_many(self, rows: List[tuple]):
+        """Insert (workflow_id, action, actor, ts, note) rows in one transaction."""
+        with self._connect() as conn:
+            conn.executemany(
                 "INSERT INTO workflow_audit (workflow_id, action, actor, ts, note)"
                 " VALUES (?,?,?,?,?)",
-                (workflow_id, action, actor, ts, note),
+                rows,
             )
             conn.commit()
 
+    def add_audit(self, workflow_id: str, action: str, actor: str, note: str = ""):
+        ts = datetime.datetime.utcnow().isoformat() + "Z"
+        with self._connect() as conn:
+            c = conn.cursor()
+            self._insert_audit(c, workflow_id, action, actor, note, ts)
+            conn.commit()
+
     def get_audit(self, workflow_id: str):
         with self._connect() as conn:
             c = conn.cursor()
@@ -263,6 +960,64 @@ class DB:
             )
             return [dict(r) for r in c.fetchall()]
 
+# Set while a public DB method is being timed on this thread. Only the
+# outermost call is reported, so validate_token -> resolve_token or
+# get_script -> scripts_snapshot isn't counted twice.
+_timing = threading.local()
+
+def _timed(name: str, fn):
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if not self.method_hooks or getattr(_timing, "active", False):
+            return fn(self, *args, **kwargs)
+        _timing.active = True
+        started = time.perf_counter()
+        error = None
+        result = None
+        try:
+            result = fn(self, *args, **kwargs)
+            return _timed_generator(self, name, result, time.perf_counter() - started) \
+                if inspect.isgenerator(result) else result
+        except Exception as e:
+            # Hooks get the exception itself so they can tell lock errors apart.
+            error = e
+            raise
+        finally:
+            _timing.active = False
+            if not inspect.isgenerator(result):
+                elapsed = time.perf_counter() - started
+                for hook in self.method_hooks:
+                    hook(name, elapsed, error)
+    return wrapper
+
+def _timed_generator(db: "DB", name: str, gen, elapsed: float):
+    # iter_* methods do their work while being consumed: add up the time
+    # spent inside each step (not in the consumer) and report once done.
+    error = None
+    try:
+        while True:
+            _timing.active = True
+            started = time.perf_counter()
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - started
+                _timing.active = False
+            yield item
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        gen.close()
+        for hook in db.method_hooks:
+            hook(name, elapsed, error)
+
+for _name, _fn in list(vars(DB).items()):
+    if callable(_fn) and not _name.startswith("_"):
+        setattr(DB, _name, _timed(_name, _fn))
+
 DB_FILE = os.environ.get("DB_FILE", "controller_data/controller.db")
 os.makedirs(os.path.dirname(DB_FILE) or ".", exist_ok=True)
 _db_instance = DB(DB_FILE)
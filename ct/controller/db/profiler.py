@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import os, sqlite3, threading, time, datetime
+from collections import deque
+from typing import Any, Dict, Optional
+
+DB_PROFILE = os.environ.get("DB_PROFILE", "0") == "1"
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", 200))
+DB_SLOW_LOG_SIZE = int(os.environ.get("DB_SLOW_LOG_SIZE", 200))
+
+_WRITE_VERBS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+_NO_PLAN_VERBS = ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "CREATE", "DROP", "ALTER", "EXPLAIN")
+
+class QueryProfiler:
+    """
+    Per-statement and per-DB-method timings, off unless enabled.
+    For each SQL text it keeps calls, wall time, rows returned/affected and
+    lock wait. Lock wait is the time spent in a statement that has to take
+    the write lock (BEGIN IMMEDIATE, or the first write of a deferred
+    transaction), which is where busy_timeout waits happen.
+    Statements slower than slow_ms are logged with their EXPLAIN QUERY PLAN.
+    """
+
+    def __init__(self, enabled: bool = DB_PROFILE, slow_ms: float = DB_SLOW_QUERY_MS):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self.statements = {}
+        self.methods = {}
+        self.slow_log = deque(maxlen=DB_SLOW_LOG_SIZE)
+
+    def configure(self, enabled: bool = None, slow_ms: float = None):
+        if enabled is not None:
+            self.enabled = enabled
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+            self.methods.clear()
+            self.slow_log.clear()
+
+    def _stat(self, sql: str) -> Dict[str, Any]:
+        stat = self.statements.get(sql)
+        if stat is None:
+            stat = self.statements[sql] = {"calls": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                           "rows": 0, "lock_wait_ms": 0.0}
+        return stat
+
+    def record_statement(self, conn, sql: str, params, elapsed: float, rows: int, takes_lock: bool):
+        ms = elapsed * 1000
+        with self._lock:
+            stat = self._stat(sql)
+            stat["calls"] += 1
+            stat["total_ms"] += ms
+            stat["max_ms"] = max(stat["max_ms"], ms)
+            stat["rows"] += max(rows, 0)
+            if takes_lock:
+                stat["lock_wait_ms"] += ms
+        if ms >= self.slow_ms:
+            self._log_slow(conn, sql, params, ms)
+
+    def record_rows(self, sql: str, rows: int):
+        with self._lock:
+            self._stat(sql)["rows"] += rows
+
+    def record_method(self, name: str, seconds: float, error: Optional[BaseException] = None):
+        if not self.enabled:
+            return
+        ms = seconds * 1000
+        with self._lock:
+            stat = self.methods.get(name)
+            if stat is None:
+                stat = self.methods[name] = {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+            stat["calls"] += 1
+            stat["errors"] += int(error is not None)
+            stat["total_ms"] += ms
+            stat["max_ms"] = max(stat["max_ms"], ms)
+
+    def _log_slow(self, conn, sql: str, params, ms: float):
+        plan = []
+        if not sql.lstrip().upper().startswith(_NO_PLAN_VERBS):
+            try:
+                # Base-class execute so the EXPLAIN itself isn't profiled.
+                rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+                plan = [r[3] for r in rows]
+            except sqlite3.Error as e:
+                plan = [f"explain failed: {e}"]
+        entry = {"ts": datetime.datetime.utcnow().isoformat() + "Z", "ms": round(ms, 3),
+                 "sql": sql, "plan": plan}
+        with self._lock:
+            self.slow_log.append(entry)
+        print(f"⚠️ slow query {ms:.1f}ms: {sql} | plan: {'; '.join(plan)}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            statements = sorted(
+                ({"sql": sql, **stat} for sql, stat in self.statements.items()),
+                key=lambda s: s["total_ms"], reverse=True,
+            )
+            return {
+                "enabled": self.enabled,
+                "slow_ms": self.slow_ms,
+                "methods": {k: dict(v) for k, v in self.methods.items()},
+                "statements": statements,
+                "slow_log": list(self.slow_log),
+            }
+
+class ProfiledCursor(sqlite3.Cursor):
+    def _profiled(self, run, sql: str, params, many: bool):
+        profiler = self.connection.profiler
+        if profiler is None or not profiler.enabled:
+            return run(sql, params)
+        verb = sql.lstrip()[:16].upper()
+        takes_lock = verb.startswith("BEGIN IMMEDIATE") or (
+            verb.startswith(_WRITE_VERBS) and not self.connection.in_transaction)
+        started = time.perf_counter()
+        result = run(sql, params)
+        elapsed = time.perf_counter() - started
+        rows = self.rowcount if verb.startswith(_WRITE_VERBS) else 0
+        explain_params = (params[0] if params else ()) if many else params
+        profiler.record_statement(self.connection, sql, explain_params, elapsed, rows, takes_lock)
+        self._profiled_sql = sql
+        return result
+
+    def execute(self, sql, params=()):
+        return self._profiled(super().execute, sql, params, False)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        return self._profiled(super().executemany, sql, seq_of_params, True)
+
+    def _count(self, rows):
+        sql = getattr(self, "_profiled_sql", None)
+        if sql and self.connection.profiler.enabled:
+            self.connection.profiler.record_rows(sql, rows)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size if size is not None else self.arraysize)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._count(len(rows))
+        return rows
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose cursors report to self.profiler when it is enabled."""
+
+    profiler = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
@@ -1,8 +1,11 @@
-from fastapi import Header,HTTPException 
+from fastapi import Header,HTTPException,Request
+from typing import Any, Dict, List
+from controller.db.db import get_db
 
 import os
 
 ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 1000))
 
 def require_admin(x_admin_token: str = Header(...,convert_underscores=False)):
 
@@ -13,3 +16,26 @@ def require_admin(x_admin_token: str = Header(...,convert_underscores=False)):
         raise HTTPException(status_code=401, detail="invalid_admin_token")
     
     return True
+
+def get_principal(request: Request, x_admin_token: str = Header(...,convert_underscores=False)) -> Dict[str, Any]:
+    """
+    Resolve the caller's token to its name (the actor) and role once per
+    request. The result is kept on request.state so handlers and helpers
+    reuse it; an unknown token gets no actor and no role.
+    """
+    principal = getattr(request.state, "principal", None)
+    if principal is None:
+        principal = get_db().resolve_principal(x_admin_token) or {"actor": None, "role": None}
+        request.state.principal = principal
+    return principal
+
+def check_batch_size(items: list) -> None:
+    if not items:
+        raise HTTPException(status_code=400, detail="empty batch")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"batch larger than {BATCH_MAX_ITEMS} items")
+
+def require_role(principal: Dict[str, Any], roles: List[str], detail: str = "invalid token") -> str:
+    if principal.get("role") not in roles:
+        raise HTTPException(status_code=401, detail=detail)
+    return principal["actor"]
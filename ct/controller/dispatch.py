@@ -0,0 +1,132 @@
+import os, asyncio, time
+from typing import Any, Dict, List, Optional
+import httpx
+
+DISPATCH_CONCURRENCY = int(os.environ.get("DISPATCH_CONCURRENCY", 50))
+DISPATCH_MAX_PARALLEL = int(os.environ.get("DISPATCH_MAX_PARALLEL", 20))
+# Default per-target run limit; unset means no limit, like local runs.
+DISPATCH_TIMEOUT_S = float(os.environ["DISPATCH_TIMEOUT_S"]) if os.environ.get("DISPATCH_TIMEOUT_S") else None
+# Extra time the HTTP call waits beyond the agent's own kill timer, so the
+# agent's timeout response (with partial output) arrives before ours fires.
+DISPATCH_TIMEOUT_GRACE_S = float(os.environ.get("DISPATCH_TIMEOUT_GRACE_S", 10))
+DISPATCH_CONNECT_TIMEOUT_S = float(os.environ.get("DISPATCH_CONNECT_TIMEOUT_S", 5))
+
+def _agent_api_key() -> str:
+    # Same lookup as the agent: env first, then controller/api.key.
+    key = os.environ.get("AGENT_API_KEY")
+    if key:
+        return key
+    key_file = os.path.join(os.path.dirname(__file__), "api.key")
+    if os.path.exists(key_file):
+        with open(key_file) as f:
+            return f.read().strip()
+    return ""
+
+AGENT_API_KEY = _agent_api_key()
+
+class AgentDispatcher:
+    """
+    Sends a script to many agents in parallel.
+    A global semaphore caps in-flight calls across all jobs; each run also
+    gets its own max_parallel cap and a per-target timeout.
+    """
+
+    def __init__(self, concurrency: int = DISPATCH_CONCURRENCY):
+        self.concurrency = concurrency
+        self._global = None
+        self._client = None
+        self.in_flight = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"concurrency": self.concurrency, "in_flight": self.in_flight}
+
+    async def start(self):
+        if self._client is not None:
+            return
+        self._global = asyncio.Semaphore(self.concurrency)
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.concurrency,
+                                max_keepalive_connections=self.concurrency),
+        )
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def run(self, agents: Dict[str, Dict[str, Any]], targets: List[str],
+                  payload: Dict[str, Any], max_parallel: Optional[int] = None,
+                  timeout_s: Optional[float] = None, on_result=None) -> Dict[str, Dict[str, Any]]:
+        await self.start()
+        local = asyncio.Semaphore(max_parallel or DISPATCH_MAX_PARALLEL)
+        if timeout_s is None:
+            timeout_s = DISPATCH_TIMEOUT_S
+        results = {}
+
+        async def one(target: str):
+            async with local, self._global:
+                results[target] = await self._call(agents.get(target), target, payload, timeout_s)
+            if on_result:
+                on_result(target, results[target])
+
+        tasks = [asyncio.ensure_future(one(t)) for t in dict.fromkeys(targets)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # If one target raised or the job was cancelled, stop the rest
+            # before the job is settled so none reports into it afterwards.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return results
+
+    async def _call(self, agent: Optional[Dict[str, Any]], target: str,
+                    payload: Dict[str, Any], timeout_s: Optional[float]) -> Dict[str, Any]:
+        if not agent or not agent.get("host") or not agent.get("port"):
+            return {"status": "failed", "returncode": None, "error": "unknown agent"}
+        url = f"http://{agent['host']}:{agent['port']}/execute"
+        started = time.monotonic()
+        self.in_flight += 1
+        if timeout_s is None:
+            body, read_timeout = payload, None
+        else:
+            body, read_timeout = dict(payload, timeout_s=timeout_s), timeout_s + DISPATCH_TIMEOUT_GRACE_S
+        try:
+            r = await self._client.post(
+                url,
+                json=body,
+                headers={"x_agent_key": AGENT_API_KEY},
+                timeout=httpx.Timeout(read_timeout, connect=DISPATCH_CONNECT_TIMEOUT_S),
+            )
+            elapsed = round(time.monotonic() - started, 3)
+            if r.status_code != 200:
+                return {"status": "failed", "returncode": None, "elapsed_s": elapsed,
+                        "error": f"HTTP {r.status_code}: {r.text[:500]}"}
+            try:
+                data = r.json()
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                return {"status": "failed", "returncode": None, "elapsed_s": elapsed,
+                        "error": f"invalid reply: {r.text[:500]}"}
+            rc = data.get("returncode")
+            return {
+                "status": "success" if rc == 0 else "failed",
+                "returncode": rc,
+                "stdout": data.get("stdout", ""),
+                "stderr": data.get("stderr", ""),
+                "elapsed_s": elapsed,
+            }
+        except httpx.TimeoutException:
+            return {"status": "timeout", "returncode": None,
+                    "elapsed_s": round(time.monotonic() - started, 3), "error": "timed out"}
+        except httpx.HTTPError as e:
+            return {"status": "failed", "returncode": None,
+                    "elapsed_s": round(time.monotonic() - started, 3), "error": str(e)}
+        finally:
+            self.in_flight -= 1
+
+_dispatcher_instance = AgentDispatcher()
+
+def get_dispatcher() -> AgentDispatcher:
+    return _dispatcher_instance
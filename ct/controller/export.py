@@ -0,0 +1,18 @@
+from typing import Any, Dict, Iterable, List
+from fastapi.responses import StreamingResponse
+from controller.fastjson import dumps
+
+def ndjson_response(batches: Iterable[List[Dict[str, Any]]], filename: str) -> StreamingResponse:
+    """
+    Stream row batches as newline-delimited JSON, one object per line.
+    Each batch becomes one chunk so memory stays flat however many rows there are.
+    """
+    def lines():
+        for rows in batches:
+            yield b"".join(dumps(r) + b"\n" for r in rows)
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -0,0 +1,44 @@
+"""
+JSON encoding for API responses. Uses orjson when it is installed
+(pip install orjson) and the stdlib otherwise; output is the same apart
+from whitespace.
+"""
+import json, functools
+from typing import Any, Optional
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_DECODE_CACHE_SIZE = 4096
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+@functools.lru_cache(maxsize=JSON_DECODE_CACHE_SIZE)
+def decode_json(text: Optional[str], default: str = "null") -> Any:
+    """
+    Parse a JSON column, memoised on its text. The result is shared between
+    callers: serialise it, never mutate it.
+    """
+    try:
+        return orjson.loads(text or default) if orjson is not None else json.loads(text or default)
+    except ValueError:
+        return None
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+def json_response(content: Any, response: Optional[Response] = None, status_code: int = 200) -> FastJSONResponse:
+    """
+    Encode content directly, skipping FastAPI's jsonable_encoder pass.
+    Headers already set on the handler's injected response are carried over.
+    """
+    headers = dict(response.headers) if response is not None else None
+    return FastJSONResponse(content, status_code=status_code, headers=headers)
@@ -0,0 +1,107 @@
+import os, json, datetime, threading, time
+from typing import Any, Dict, Optional
+from controller.db.db import DB, get_db, metadata_hash
+
+HEARTBEAT_FLUSH_MS = int(os.environ.get("HEARTBEAT_FLUSH_MS", 500))
+HEARTBEAT_MAX_STALENESS_MS = int(os.environ.get("HEARTBEAT_MAX_STALENESS_MS", 5000))
+
+class HeartbeatBuffer:
+    """
+    Write-behind buffer for agent heartbeats.
+    Keeps the latest status/metadata/last_seen per agent in memory and
+    writes every dirty agent in one executemany transaction per flush.
+    """
+
+    def __init__(self, db: DB, flush_ms: int = HEARTBEAT_FLUSH_MS,
+                 max_staleness_ms: int = HEARTBEAT_MAX_STALENESS_MS):
+        self.db = db
+        self.flush_ms = flush_ms
+        self.max_staleness_ms = max_staleness_ms
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._oldest = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"recorded": 0, "flushes": 0, "flushed_rows": 0, "errors": 0}
+
+    def record(self, agent_name: str, status: str, metadata: Optional[Dict[str, Any]],
+               md_hash: Optional[str] = None) -> tuple:
+        """
+        Buffer a beat and return it as (status, metadata_json, last_seen, metadata_hash).
+        metadata=None means "unchanged": only status and last_seen are written.
+        """
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        if metadata is None:
+            beat = (status, None, now, None)
+        else:
+            beat = (status, json.dumps(metadata), now, md_hash or metadata_hash(metadata))
+        with self._lock:
+            self._pending[agent_name] = self._merge(self._pending.get(agent_name), beat)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self.stats["recorded"] += 1
+            stale = (time.monotonic() - self._oldest) * 1000 >= self.max_staleness_ms
+        # The flusher is late (not started, or stuck behind the write lock):
+        # never let a heartbeat sit longer than max_staleness_ms.
+        if stale:
+            self.flush()
+        return beat
+
+    @staticmethod
+    def _merge(older: Optional[tuple], newer: tuple) -> tuple:
+        # A metadata-less beat must not drop metadata still waiting to be written.
+        if older is None or newer[1] is not None or older[1] is None:
+            return newer
+        return (newer[0], older[1], newer[2], older[3])
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._oldest = None
+            if not batch:
+                return 0
+            try:
+                self.db.heartbeat_many([(name,) + beat for name, beat in batch.items()])
+            except Exception as e:
+                print(f"❌ Heartbeat flush failed ({len(batch)} agents): {e}")
+                with self._lock:
+                    for name, beat in batch.items():
+                        newer = self._pending.get(name)
+                        self._pending[name] = self._merge(beat, newer) if newer else beat
+                    if self._oldest is None:
+                        self._oldest = time.monotonic()
+                    self.stats["errors"] += 1
+                return 0
+            with self._lock:
+                self.stats["flushes"] += 1
+                self.stats["flushed_rows"] += len(batch)
+            return len(batch)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_ms / 1000.0):
+            self.flush()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="heartbeat-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+_buffer_instance = HeartbeatBuffer(get_db())
+
+def get_heartbeat_buffer() -> HeartbeatBuffer:
+    return _buffer_instance
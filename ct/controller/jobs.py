@@ -0,0 +1,325 @@
+import os, asyncio, datetime, secrets, threading, time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from controller.db.db import DB, get_db
+from controller.dispatch import get_dispatcher
+from controller.liveness import get_liveness_tracker
+from controller.audit import get_audit_writer
+from controller import metrics
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 1000))
+JOB_HISTORY = int(os.environ.get("JOB_HISTORY", 500))
+JOB_OUTPUT_LINES = int(os.environ.get("JOB_OUTPUT_LINES", 10000))
+
+def _now() -> str:
+    return datetime.datetime.utcnow().isoformat() + "Z"
+
+class JobQueueFull(Exception):
+    pass
+
+class JobEngine:
+    """
+    Runs approved workflow scripts as asyncio subprocesses on a fixed number
+    of worker tasks. Requests only enqueue and get a job_id back.
+    """
+
+    def __init__(self, db: DB, workers: int = JOB_WORKERS,
+                 queue_size: int = JOB_QUEUE_SIZE, history: int = JOB_HISTORY):
+        self.db = db
+        self.workers = workers
+        self.queue_size = queue_size
+        self.history = history
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._queued = 0
+        self._loop = None
+        self._queue = None
+        self._tasks = []
+
+    # ---- lifecycle (called from the app's event loop) ----
+
+    async def start(self):
+        if self._tasks:
+            return
+        # Jobs are in-memory only: workflows still "running" belonged to a
+        # previous process and nothing will ever finish them.
+        lost = self.db.cancel_running_workflows("job-engine", "controller restarted during execution")
+        if lost:
+            print(f"⚠️ Cancelled {lost} workflow(s) left running by a previous controller")
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Running jobs settled themselves on cancellation; settle the queued ones.
+        while not self._queue.empty():
+            job = self._queue.get_nowait()
+            with self._lock:
+                self._queued -= 1
+            self._record(job, "cancelled")
+            self._finish(job, "cancelled")
+        await get_dispatcher().stop()
+
+    # ---- public API (safe to call from threadpool routes) ----
+
+    def submit(self, workflow_id: str, script_path: str, actor: str,
+               targets: Optional[List[str]] = None, script_id: str = "",
+               max_parallel: Optional[int] = None, timeout_s: Optional[float] = None) -> Dict[str, Any]:
+        if self._loop is None:
+            raise RuntimeError("job engine not started")
+        job = {
+            "job_id": secrets.token_urlsafe(12),
+            "workflow_id": workflow_id,
+            "script_id": script_id,
+            "script_path": script_path,
+            "actor": actor,
+            "targets": targets or [],
+            "max_parallel": max_parallel,
+            "timeout_s": timeout_s,
+            "status": "queued",
+            "created_at": _now(),
+            "started_at": None,
+            "finished_at": None,
+            "returncode": None,
+            "output": [],
+            "output_base": 0,
+            "results": {},
+            "_changed": asyncio.Event(),
+            "progress": {"stdout_lines": 0, "stderr_lines": 0, "elapsed_s": 0.0},
+        }
+        if job["targets"]:
+            job["progress"].update(targets_total=len(job["targets"]), targets_done=0, targets_failed=0)
+        with self._lock:
+            if self._queued >= self.queue_size:
+                raise JobQueueFull()
+            self._queued += 1
+            self._jobs[job["job_id"]] = job
+            self._prune()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_for_workflow(self, workflow_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [j for j in self._jobs.values() if j["workflow_id"] == workflow_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            running = sum(1 for j in self._jobs.values() if j["status"] == "running")
+            return {"workers": self.workers, "queued": self._queued, "running": running,
+                    "tracked": len(self._jobs)}
+
+    # ---- internals ----
+
+    def _prune(self):
+        # Drop the oldest finished jobs beyond the history limit.
+        excess = len(self._jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id in [k for k, j in self._jobs.items() if j["finished_at"]][:excess]:
+            del self._jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            with self._lock:
+                self._queued -= 1
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _touch(self, job: Dict[str, Any]):
+        # Wake stream followers; they re-arm on the fresh event.
+        changed, job["_changed"] = job["_changed"], asyncio.Event()
+        changed.set()
+
+    def _append(self, job: Dict[str, Any], stream: str, text: str):
+        # Output is a bounded line buffer; output_base is the absolute offset
+        # of output[0] so followers can resume by offset after trimming.
+        out = job["output"]
+        out.append((stream, text.rstrip("\n")))
+        if len(out) > JOB_OUTPUT_LINES:
+            drop = len(out) - JOB_OUTPUT_LINES + JOB_OUTPUT_LINES // 10
+            del out[:drop]
+            job["output_base"] += drop
+        job["progress"][stream + "_lines"] += 1
+        self._touch(job)
+
+    async def _pump(self, stream, name: str, job: Dict[str, Any]):
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            self._append(job, name, line.decode(errors="replace"))
+
+    async def follow(self, job: Dict[str, Any], offset: int = 0):
+        """
+        Yield (offset, stream, text) for output lines from offset onwards,
+        waiting for new lines until the job finishes. If the requested offset
+        was already trimmed, yields (offset, "gap", skipped_count) first.
+        """
+        while True:
+            changed = job["_changed"]
+            base = job["output_base"]
+            if offset < base:
+                yield offset, "gap", str(base - offset)
+                offset = base
+            lines = job["output"][offset - base:]
+            for i, (stream, text) in enumerate(lines):
+                yield offset + i, stream, text
+            offset += len(lines)
+            if lines:
+                continue
+            if job["finished_at"]:
+                return
+            await changed.wait()
+
+    async def _run(self, job: Dict[str, Any]):
+        job["status"] = "running"
+        job["started_at"] = _now()
+        started = time.monotonic()
+        status = "failed"
+        try:
+            if job["targets"]:
+                status = await self._run_targets(job)
+            else:
+                status = await self._run_local(job)
+        except asyncio.CancelledError:
+            # Controller shutdown; don't await anything more on this task.
+            status = "cancelled"
+            raise
+        except Exception as e:
+            self._append(job, "stderr", str(e))
+        finally:
+            # However the job ended, the workflow must leave "running".
+            job["progress"]["elapsed_s"] = round(time.monotonic() - started, 3)
+            if status == "cancelled":
+                self._record(job, status)
+            else:
+                await asyncio.to_thread(self._record, job, status)
+            self._finish(job, status)
+
+    def _record(self, job: Dict[str, Any], status: str):
+        # Blocking: final workflow status plus its one audit row.
+        if job["targets"]:
+            note = f"targets={len(job['results'])} failed={job['progress']['targets_failed']}"
+        else:
+            note = f"rc={job['returncode']}"
+        try:
+            self.db.update_workflow_status(job["workflow_id"], status)
+        except Exception as e:
+            print(f"❌ Job {job['job_id']}: could not set workflow {job['workflow_id']} to {status}: {e}")
+        action = "cancelled" if status == "cancelled" else "executed"
+        get_audit_writer().record(job["workflow_id"], action, job["actor"], f"{note} job={job['job_id']}")
+
+    def _finish(self, job: Dict[str, Any], status: str):
+        job["status"] = status
+        job["finished_at"] = _now()
+        self._touch(job)
+
+    async def _run_local(self, job: Dict[str, Any]) -> str:
+        started = time.monotonic()
+        proc = None
+        pumps = []
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                job["script_path"],
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=1024 * 1024,
+            )
+            pumps = [asyncio.ensure_future(self._pump(proc.stdout, "stdout", job)),
+                     asyncio.ensure_future(self._pump(proc.stderr, "stderr", job))]
+            await asyncio.gather(*pumps)
+            returncode = await proc.wait()
+        except asyncio.CancelledError:
+            # Controller shutdown: don't leave the script running unattended.
+            await self._kill(proc, pumps)
+            raise
+        except Exception as e:
+            # E.g. an output line over the 1 MB limit: stop the script and
+            # the other pump as well.
+            await self._kill(proc, pumps)
+            returncode = -1
+            self._append(job, "stderr", str(e))
+        job["returncode"] = returncode
+        status = "success" if returncode == 0 else "failed"
+        metrics.script_duration.observe(time.monotonic() - started, "local", status)
+        return status
+
+    @staticmethod
+    async def _kill(proc, pumps: List[asyncio.Future]):
+        for pump in pumps:
+            pump.cancel()
+        if proc is not None and proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        await asyncio.gather(*pumps, return_exceptions=True)
+
+    async def _run_targets(self, job: Dict[str, Any]) -> str:
+        # Fan out to the agents registered under the target names.
+        agents = await asyncio.to_thread(self.db.get_agents, job["targets"])
+        with open(job["script_path"], "r") as f:
+            script = f.read()
+        payload = {"workflow_id": job["workflow_id"], "job_id": job["job_id"],
+                   "script_id": job["script_id"], "script": script}
+
+        def on_result(target: str, result: Dict[str, Any]):
+            job["results"][target] = result
+            if result.get("elapsed_s") is not None:
+                metrics.script_duration.observe(result["elapsed_s"], "agent", result["status"])
+            job["progress"]["targets_done"] += 1
+            if result["status"] != "success":
+                job["progress"]["targets_failed"] += 1
+            self._append(job, "stdout", f"[{target}] {result['status']} rc={result['returncode']}")
+            for name in ("stdout", "stderr"):
+                for line in (result.get(name) or "").splitlines():
+                    self._append(job, name, f"[{target}] {line}")
+            if result.get("error"):
+                self._append(job, "stderr", f"[{target}] {result['error']}")
+
+        # Don't wait out connect timeouts on agents that stopped heartbeating.
+        tracker = get_liveness_tracker()
+        live = []
+        for target in dict.fromkeys(job["targets"]):
+            if target in agents and tracker.liveness(target) == "offline":
+                on_result(target, {"status": "skipped", "returncode": None, "error": "agent offline"})
+            else:
+                live.append(target)
+        await get_dispatcher().run(agents, live, payload,
+                                   max_parallel=job["max_parallel"], timeout_s=job["timeout_s"],
+                                   on_result=on_result)
+        failed = job["progress"]["targets_failed"]
+        job["returncode"] = 0 if failed == 0 else 1
+        return "success" if failed == 0 else "failed"
+
+def job_summary(job: Dict[str, Any], include_output: bool = False) -> Dict[str, Any]:
+    out = {k: v for k, v in job.items()
+           if k not in ("output", "script_path", "results") and not k.startswith("_")}
+    if job["status"] == "running" and job["started_at"]:
+        started = datetime.datetime.fromisoformat(job["started_at"].rstrip("Z"))
+        elapsed = (datetime.datetime.utcnow() - started).total_seconds()
+        out["progress"] = dict(job["progress"], elapsed_s=round(elapsed, 3))
+    if include_output:
+        lines = list(job["output"])
+        out["stdout"] = "".join(t + "\n" for s, t in lines if s == "stdout")
+        out["stderr"] = "".join(t + "\n" for s, t in lines if s == "stderr")
+        out["results"] = dict(job["results"])
+    return out
+
+_engine_instance = JobEngine(get_db())
+
+def get_job_engine() -> JobEngine:
+    return _engine_instance
@@ -0,0 +1,264 @@
+import os, json, datetime, threading, time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from controller.db.db import metadata_hash, CollectionVersion
+from controller.fastjson import decode_json
+
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 30))
+LIVENESS_STALE_AFTER = float(os.environ.get("LIVENESS_STALE_AFTER", HEARTBEAT_INTERVAL * 2))
+LIVENESS_OFFLINE_AFTER = float(os.environ.get("LIVENESS_OFFLINE_AFTER", HEARTBEAT_INTERVAL * 5))
+LIVENESS_STATES = ("online", "stale", "offline")
+
+def _epoch(iso: Optional[str]) -> float:
+    if not iso:
+        return 0.0
+    try:
+        dt = datetime.datetime.fromisoformat(iso.rstrip("Z"))
+    except ValueError:
+        return 0.0
+    return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+class LivenessTracker:
+    """
+    In-memory view of every agent row, kept in last_seen order.
+    Liveness is derived from the age of last_seen:
+      online  <= LIVENESS_STALE_AFTER seconds
+      stale   <= LIVENESS_OFFLINE_AFTER seconds
+      offline otherwise
+    Because rows are ordered by last_seen, online/stale agents are a suffix
+    of the order and can be listed without touching the rest of the fleet.
+    Capability tags (capabilities {"tags": [...]}) are indexed tag -> agents
+    for select().
+    """
+
+    def __init__(self, stale_after: float = LIVENESS_STALE_AFTER,
+                 offline_after: float = LIVENESS_OFFLINE_AFTER):
+        self.stale_after = stale_after
+        self.offline_after = offline_after
+        self._lock = threading.Lock()
+        self._agents = OrderedDict()
+        self._by_tag = {}
+        self.version = CollectionVersion("agents")
+        # (version, offline, stale, valid_until, modified_at) behind etag().
+        self._bands = None
+
+    def load(self, agents: List[Dict[str, Any]]):
+        rows = sorted((dict(a) for a in agents), key=lambda a: a.get("last_seen") or "")
+        with self._lock:
+            self._agents.clear()
+            self._by_tag.clear()
+            for row in rows:
+                row["_seen"] = _epoch(row.get("last_seen"))
+                self._agents[row["agent_name"]] = row
+                self._index(row)
+            self.version.bump()
+
+    def register(self, agent_name: str, host: str, port: int, capabilities: Dict[str, Any],
+                 metadata: Dict[str, Any], status: str = "online"):
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        capabilities_json = json.dumps(capabilities or {}, sort_keys=True)
+        metadata_json = json.dumps(metadata or {})
+        self._touch(agent_name, {
+            "host": host,
+            "port": port,
+            "status": status,
+            "capabilities_json": capabilities_json,
+            "metadata_json": metadata_json,
+            "metadata_hash": metadata_hash(metadata),
+            "last_seen": now,
+            # Already have the parsed form; no need to decode it again for listings.
+            "_decoded": {"capabilities_json": (capabilities_json, capabilities or {}),
+                         "metadata_json": (metadata_json, metadata or {})},
+        })
+
+    def beat(self, agent_name: str, status: str, metadata_json: Optional[str], last_seen: str,
+             md_hash: Optional[str] = None, stats: Optional[Dict[str, Any]] = None):
+        fields = {"status": status, "last_seen": last_seen}
+        if metadata_json is not None:
+            fields.update(metadata_json=metadata_json, metadata_hash=md_hash)
+        if stats is not None:
+            fields["stats"] = stats
+        self._touch(agent_name, fields)
+
+    def metadata(self, agent_name: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        Current (metadata, metadata_hash) of an agent, or (None, None) if unknown.
+        The metadata dict is the tracker's cached copy; don't mutate it.
+        """
+        with self._lock:
+            row = self._agents.get(agent_name)
+            if row is None:
+                return None, None
+            metadata, md_hash = self._decoded(row, "metadata_json"), row.get("metadata_hash")
+        if md_hash is None:
+            md_hash = metadata_hash(metadata)
+            with self._lock:
+                row["metadata_hash"] = md_hash
+        return metadata, md_hash
+
+    def _touch(self, agent_name: str, fields: Dict[str, Any]):
+        with self._lock:
+            row = self._agents.get(agent_name)
+            if row is None:
+                row = {"agent_name": agent_name, "host": None, "port": None,
+                       "capabilities_json": "{}"}
+                self._agents[agent_name] = row
+            row.update(fields)
+            if "capabilities_json" in fields:
+                self._index(row)
+            row["_seen"] = time.time()
+            self._agents.move_to_end(agent_name)
+            self.version.bump()
+
+    def _index(self, row: Dict[str, Any]):
+        # Called with the lock held whenever a row's capabilities may have changed.
+        capabilities = self._decoded(row, "capabilities_json")
+        tags = capabilities.get("tags") if isinstance(capabilities, dict) else None
+        tags = frozenset(t for t in tags or () if isinstance(t, str))
+        old = row.get("_tags", frozenset())
+        if tags == old:
+            return
+        name = row["agent_name"]
+        for tag in old - tags:
+            agents = self._by_tag[tag]
+            agents.discard(name)
+            if not agents:
+                del self._by_tag[tag]
+        for tag in tags - old:
+            self._by_tag.setdefault(tag, set()).add(name)
+        row["_tags"] = tags
+
+    def select(self, all_tags: Iterable[str] = (), any_tags: Iterable[str] = (),
+               exclude_tags: Iterable[str] = (), liveness: Optional[str] = None) -> List[str]:
+        """
+        Names of agents carrying every tag in all_tags, at least one of
+        any_tags and none of exclude_tags, optionally only those currently
+        in the given liveness state. Empty all_tags/any_tags don't restrict.
+        """
+        all_tags, any_tags = list(all_tags), list(any_tags)
+        now = time.time()
+        with self._lock:
+            if all_tags:
+                # Intersect starting from the rarest tag to keep the sets small.
+                sets = sorted((self._by_tag.get(t, set()) for t in all_tags), key=len)
+                result = set(sets[0]).intersection(*sets[1:])
+            else:
+                result = None
+            if any_tags:
+                union = set().union(*(self._by_tag.get(t, set()) for t in any_tags))
+                result = union if result is None else result & union
+            if result is None:
+                result = set(self._agents)
+            for tag in exclude_tags:
+                result -= self._by_tag.get(tag, set())
+            if liveness:
+                result = {n for n in result if self.state(self._agents[n]["_seen"], now) == liveness}
+        return sorted(result)
+
+    def tags(self) -> Dict[str, int]:
+        """Agent count per capability tag."""
+        with self._lock:
+            return {tag: len(agents) for tag, agents in sorted(self._by_tag.items())}
+
+    def state(self, seen: float, now: Optional[float] = None) -> str:
+        age = (now or time.time()) - seen
+        if age <= self.stale_after:
+            return "online"
+        if age <= self.offline_after:
+            return "stale"
+        return "offline"
+
+    def liveness(self, agent_name: str) -> Optional[str]:
+        with self._lock:
+            row = self._agents.get(agent_name)
+            return self.state(row["_seen"]) if row else None
+
+    def list(self, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        now = time.time()
+        out = []
+        with self._lock:
+            if status in ("online", "stale"):
+                # Walk back from the most recently seen agent and stop as soon
+                # as we pass the requested band.
+                for row in reversed(self._agents.values()):
+                    state = self.state(row["_seen"], now)
+                    if state == "offline" or (status == "online" and state != "online"):
+                        break
+                    if state == status:
+                        out.append(self._public(row, state))
+            else:
+                for row in self._agents.values():
+                    state = self.state(row["_seen"], now)
+                    if status and state != status:
+                        break
+                    out.append(self._public(row, state))
+        return out
+
+    def _liveness_bands(self, now: float) -> Tuple[int, int, float]:
+        # Called with the lock held. Offline and stale counts plus the time
+        # the next agent moves band; only walks the offline/stale prefix.
+        offline = stale = 0
+        until = float("inf")
+        for row in self._agents.values():
+            state = self.state(row["_seen"], now)
+            if state == "offline":
+                offline += 1
+            elif state == "stale":
+                stale += 1
+                until = min(until, row["_seen"] + self.offline_after)
+            else:
+                until = min(until, row["_seen"] + self.stale_after)
+                break
+        return offline, stale, until
+
+    def etag(self, status: Optional[str] = None) -> Tuple[str, float]:
+        """
+        (ETag, Last-Modified epoch) for list(status). Changes on every row
+        update and whenever the passage of time moves an agent to another
+        liveness band; between those it is answered without a scan.
+        """
+        now = time.time()
+        with self._lock:
+            version = self.version.value
+            bands = self._bands
+            if bands is None or bands[0] != version or now >= bands[3]:
+                offline, stale, until = self._liveness_bands(now)
+                modified_at = self.version.modified_at
+                if bands is not None and bands[3] <= now:
+                    # An agent changed band exactly at the previous deadline.
+                    modified_at = max(modified_at, bands[3])
+                bands = self._bands = (version, offline, stale, until, modified_at)
+            etag = self.version.etag("%d.%d|%s" % (bands[1], bands[2], status or ""))
+            return etag, bands[4]
+
+    def counts(self) -> Dict[str, int]:
+        now = time.time()
+        counts = dict.fromkeys(LIVENESS_STATES, 0)
+        with self._lock:
+            for row in self._agents.values():
+                counts[self.state(row["_seen"], now)] += 1
+        return counts
+
+    @staticmethod
+    def _decoded(row: Dict[str, Any], column: str) -> Any:
+        # Parsed form of a JSON column, kept on the row until its text is replaced.
+        text = row.get(column)
+        cache = row.setdefault("_decoded", {})
+        hit = cache.get(column)
+        if hit is None or hit[0] is not text:
+            hit = cache[column] = (text, decode_json(text, "{}") or {})
+        return hit[1]
+
+    @classmethod
+    def _public(cls, row: Dict[str, Any], state: str) -> Dict[str, Any]:
+        out = {k: v for k, v in row.items()
+               if not k.startswith("_") and k not in ("capabilities_json", "metadata_json")}
+        out["capabilities"] = cls._decoded(row, "capabilities_json")
+        out["metadata"] = cls._decoded(row, "metadata_json")
+        out["liveness"] = state
+        return out
+
+_tracker_instance = LivenessTracker()
+
+def get_liveness_tracker() -> LivenessTracker:
+    return _tracker_instance
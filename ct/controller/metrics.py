@@ -0,0 +1,86 @@
+import sqlite3, threading
+from typing import Dict, Iterable, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                yield f"{self.name}{_labels(self.labels, key)} {value}"
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                for bound, n in zip(self.buckets, counts):
+                    le = 'le="%s"' % bound
+                    yield f"{self.name}_bucket{_labels(self.labels, key, le)} {n}"
+                le = 'le="+Inf"'
+                yield f"{self.name}_bucket{_labels(self.labels, key, le)} {count}"
+                yield f"{self.name}_sum{_labels(self.labels, key)} {total}"
+                yield f"{self.name}_count{_labels(self.labels, key)} {count}"
+
+def render_gauge(name: str, help: str, label: str, values: Dict[str, float]):
+    yield f"# HELP {name} {help}"
+    yield f"# TYPE {name} gauge"
+    for key, value in sorted(values.items()):
+        yield f"{name}{_labels((label,), (key,)) if label else ''} {value}"
+
+http_request_duration = Histogram(
+    "controller_http_request_duration_seconds", "HTTP request latency by route.",
+    ("method", "route", "status"))
+db_call_duration = Histogram(
+    "controller_db_call_duration_seconds", "Time spent in each DB method.", ("method",))
+db_call_errors = Counter(
+    "controller_db_call_errors_total", "DB method calls that raised.", ("method",))
+db_lock_errors = Counter(
+    "controller_db_lock_errors_total", "DB method calls that failed with SQLITE_BUSY/locked.", ("method",))
+script_duration = Histogram(
+    "controller_script_duration_seconds", "Workflow script run time.", ("mode", "status"))
+
+def observe_db(method: str, seconds: float, error: Optional[BaseException] = None):
+    db_call_duration.observe(seconds, method)
+    if error is not None:
+        db_call_errors.inc(method)
+        if isinstance(error, sqlite3.OperationalError) and "locked" in str(error):
+            db_lock_errors.inc(method)
@@ -0,0 +1,62 @@
+import os, datetime, threading, time
+from controller.db.db import DB, get_db
+
+EXPIRY_SWEEP_INTERVAL = float(os.environ.get("EXPIRY_SWEEP_INTERVAL", 30))
+
+class ExpirySweeper:
+    """
+    Background thread that expires due workflows in bulk every
+    EXPIRY_SWEEP_INTERVAL seconds via DB.expire_due_workflows.
+    """
+
+    def __init__(self, db: DB, interval: float = EXPIRY_SWEEP_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {
+            "runs": 0,
+            "last_run_at": None,
+            "last_duration_ms": None,
+            "last_expired": 0,
+            "total_expired": 0,
+            "errors": 0,
+        }
+
+    def sweep(self) -> int:
+        started = time.monotonic()
+        try:
+            expired = self.db.expire_due_workflows()
+        except Exception as e:
+            print(f"❌ Expiry sweep failed: {e}")
+            self.stats["errors"] += 1
+            return 0
+        self.stats["runs"] += 1
+        self.stats["last_run_at"] = datetime.datetime.utcnow().isoformat() + "Z"
+        self.stats["last_duration_ms"] = round((time.monotonic() - started) * 1000, 3)
+        self.stats["last_expired"] = expired
+        self.stats["total_expired"] += expired
+        return expired
+
+    def _run(self):
+        self.sweep()
+        while not self._stop.wait(self.interval):
+            self.sweep()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="expiry-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+_sweeper_instance = ExpirySweeper(get_db())
+
+def get_expiry_sweeper() -> ExpirySweeper:
+    return _sweeper_instance
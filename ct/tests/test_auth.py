@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Per-user tokens reach the principal-based routers; the shared ADMIN_TOKEN
+only gates the agent register/heartbeat routes.
+
+Run from ct/: python -m pytest tests
+"""
+import atexit, os, shutil, tempfile, unittest
+
+# controller.db.db opens DB_FILE on import; every test module points it at
+# the same per-run directory, outside controller_data/.
+_RUN_DIR = os.path.join(tempfile.gettempdir(), f"ct-test-{os.getpid()}")
+os.environ["DB_FILE"] = os.path.join(_RUN_DIR, "controller.db")
+atexit.register(shutil.rmtree, _RUN_DIR, True)
+os.environ.setdefault("ADMIN_TOKEN", "test-admin-token")
+
+from fastapi.testclient import TestClient
+
+from controller.controller import app
+from controller.db.db import get_db
+
+
+class PrincipalAuthTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        db = get_db()
+        db.create_token("auth-approver-1", "auth-approver-1-secret", "approver")
+        db.create_token("auth-approver-2", "auth-approver-2-secret", "approver")
+        db.create_token("auth-viewer", "auth-viewer-secret", "viewer")
+        db.create_workflow("auth-wf", "s1", [], "alice", 2, "", 60, "two approvers")
+
+    def test_two_approvers_approve(self):
+        with TestClient(app) as client:
+            first = client.post("/api/workflows/auth-wf/approve", json={},
+                                headers={"x_admin_token": "auth-approver-1-secret"})
+            again = client.post("/api/workflows/auth-wf/approve", json={},
+                                headers={"x_admin_token": "auth-approver-1-secret"})
+            second = client.post("/api/workflows/auth-wf/approve", json={},
+                                 headers={"x_admin_token": "auth-approver-2-secret"})
+        self.assertEqual(first.status_code, 200, first.text)
+        self.assertEqual(first.json()["status"], "pending")
+        self.assertTrue(again.json()["already_approved"])
+        self.assertEqual(second.json()["status"], "approved")
+        self.assertEqual(second.json()["approvals"], 2)
+
+    def test_roles_still_enforced(self):
+        with TestClient(app) as client:
+            viewer = client.post("/api/workflows/auth-wf/approve", json={},
+                                 headers={"x_admin_token": "auth-viewer-secret"})
+            unknown = client.get("/api/workflows/", headers={"x_admin_token": "nope"})
+        self.assertEqual(viewer.status_code, 401)
+        self.assertEqual(unknown.status_code, 401)
+
+    def test_agent_routes_keep_shared_token(self):
+        with TestClient(app) as client:
+            r = client.post("/api/agents/heartbeat", json={"agent_name": "a1", "status": "online"},
+                            headers={"x_admin_token": "auth-viewer-secret"})
+        self.assertEqual(r.status_code, 401)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+The hot queries must be served by the indexes added in the migrations.
+
+Run from ct/: python -m pytest tests  (or python -m unittest discover -s tests)
+"""
+import atexit, os, shutil, sqlite3, tempfile, unittest
+
+# controller.db.db opens DB_FILE on import; every test module points it at
+# the same per-run directory, outside controller_data/.
+_RUN_DIR = os.path.join(tempfile.gettempdir(), f"ct-test-{os.getpid()}")
+os.environ["DB_FILE"] = os.path.join(_RUN_DIR, "controller.db")
+atexit.register(shutil.rmtree, _RUN_DIR, True)
+_TMP = tempfile.mkdtemp(prefix="ct-test-")
+
+from controller.db.db import DB
+
+
+class IndexUsageTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(_TMP, f"{self._testMethodName}.db")
+        self.db = DB(self.path)
+        self.db.create_token("t1", "secret-1", "admin")
+        for i in range(3):
+            self.db.create_workflow(f"wf{i}", "s1", [], "r", 1, "", 60, "alice")
+
+    def tearDown(self):
+        self.db.close()
+
+    def _traced(self, call, prefix):
+        # Capture the statements a DB method really runs, then ask SQLite how
+        # it would execute the one we care about.
+        statements = []
+        conn = self.db._connect()
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+        matching = [s for s in statements if s.lstrip().upper().startswith(prefix)]
+        self.assertTrue(matching, f"no {prefix} statement traced in {statements}")
+        plan = sqlite3.connect(self.path)
+        try:
+            rows = plan.execute("EXPLAIN QUERY PLAN " + matching[-1]).fetchall()
+        finally:
+            plan.close()
+        return " | ".join(r[-1] for r in rows)
+
+    def assertUsesIndex(self, plan, index):
+        self.assertIn(index, plan, f"{index} not used: {plan}")
+
+    def test_list_workflows_uses_created_id(self):
+        plan = self._traced(lambda: self.db.list_workflows(limit=10), "SELECT")
+        self.assertUsesIndex(plan, "idx_workflows_created_id")
+        plan = self._traced(
+            lambda: self.db.list_workflows(limit=10, after=("9999", "wf9")), "SELECT")
+        self.assertUsesIndex(plan, "idx_workflows_created_id")
+
+    def test_get_audit_uses_wf_ts(self):
+        plan = self._traced(lambda: self.db.get_audit("wf0"), "SELECT")
+        self.assertUsesIndex(plan, "idx_workflow_audit_wf_ts")
+
+    def test_resolve_token_uses_hash(self):
+        self.db.token_cache.clear()
+        plan = self._traced(lambda: self.db.resolve_token("secret-1"), "SELECT ROLE")
+        self.assertUsesIndex(plan, "idx_tokens_hash")
+
+    def test_expiry_uses_status_expires(self):
+        plan = self._traced(self.db.expire_due_workflows, "UPDATE")
+        self.assertUsesIndex(plan, "idx_workflows_status_expires")
+
+    def test_migrate_is_idempotent(self):
+        version = self.db.schema_version()
+        again = DB(self.path)
+        try:
+            self.assertEqual(again.schema_version(), version)
+            with again._connect() as conn:
+                applied = conn.execute(
+                    "SELECT count(*) FROM schema_version WHERE version=?", (version,)
+                ).fetchone()[0]
+            self.assertEqual(applied, 1)
+        finally:
+            again.close()
+
+
+def tearDownModule():
+    shutil.rmtree(_TMP, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
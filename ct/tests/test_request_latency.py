@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Requests to the /api routers go through the latency middleware and are
+labelled with their full route template.
+
+Run from ct/: python -m pytest tests
+"""
+import atexit, os, shutil, tempfile, unittest
+
+# controller.db.db opens DB_FILE on import; every test module points it at
+# the same per-run directory, outside controller_data/.
+_RUN_DIR = os.path.join(tempfile.gettempdir(), f"ct-test-{os.getpid()}")
+os.environ["DB_FILE"] = os.path.join(_RUN_DIR, "controller.db")
+atexit.register(shutil.rmtree, _RUN_DIR, True)
+os.environ.setdefault("ADMIN_TOKEN", "test-admin-token")
+ADMIN_TOKEN = os.environ["ADMIN_TOKEN"]
+
+from fastapi.testclient import TestClient
+
+from controller.controller import app
+from controller.db.db import get_db
+from controller import metrics
+
+
+class RequestLatencyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        get_db().create_token("test-admin", ADMIN_TOKEN, "admin")
+
+    def _count(self, method, route):
+        # Sum of the +Inf buckets, i.e. the number of observed requests.
+        total = 0
+        for line in metrics.http_request_duration.render():
+            if f'method="{method}"' in line and f'route="{route}"' in line and 'le="+Inf"' in line:
+                total += float(line.rsplit(" ", 1)[1])
+        return total
+
+    def test_api_route_is_labelled_with_prefix(self):
+        before = self._count("GET", "/api/agents/")
+        with TestClient(app) as client:
+            r = client.get("/api/agents/", headers={"x_admin_token": ADMIN_TOKEN})
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(self._count("GET", "/api/agents/"), before + 1)
+
+    def test_path_template_not_raw_path(self):
+        before = self._count("GET", "/api/workflows/{workflow_id}")
+        with TestClient(app) as client:
+            r = client.get("/api/workflows/no-such-wf", headers={"x_admin_token": ADMIN_TOKEN})
+        self.assertEqual(r.status_code, 404, r.text)
+        self.assertEqual(self._count("GET", "/api/workflows/{workflow_id}"), before + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
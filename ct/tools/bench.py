@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Controller benchmarks: HTTP endpoints (in-process, via the FastAPI test
+client) and DB-layer methods, against a throwaway DB_FILE.
+
+Run from ct/:
+    python tools/bench.py --agents 1000 --workflows 5000 --out bench.json
+    python tools/bench.py --baseline bench.json --max-regression 0.25
+
+Each result reports n, ops_per_s and mean/p50/p99 latency in ms. With
+--baseline, p50 latencies are compared against an earlier run and the
+exit status is 1 if any got worse by more than --max-regression.
+"""
+import os, sys, json, time, shutil, sqlite3, argparse, platform, tempfile, datetime, statistics
+import contextlib
+
+CT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CT_DIR)
+
+ADMIN_TOKEN = "bench-admin-token"
+REG_SECRET = "bench-reg-secret"
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+def measure(fn, n, warmup=5):
+    """Call fn(i) n times; return throughput and latency stats. errors includes failed warmup calls."""
+    samples, errors = [], 0
+    for i in range(min(warmup, n)):
+        try:
+            fn(i)
+        except Exception:
+            errors += 1
+    started = time.perf_counter()
+    for i in range(n):
+        t0 = time.perf_counter()
+        try:
+            fn(i)
+        except Exception:
+            errors += 1
+        samples.append((time.perf_counter() - t0) * 1000)
+    wall = time.perf_counter() - started
+    return {
+        "n": n,
+        "errors": errors,
+        "ops_per_s": round(n / wall, 1) if wall else 0.0,
+        "mean_ms": round(statistics.mean(samples), 4) if samples else 0.0,
+        "p50_ms": round(percentile(samples, 50), 4),
+        "p99_ms": round(percentile(samples, 99), 4),
+    }
+
+def metadata_for(i):
+    return {"os": "linux", "version": "1.0.%d" % (i % 7), "cpus": 8, "mem_mb": 16384,
+            "labels": ["rack-%d" % (i % 20), "zone-%d" % (i % 3)]}
+
+def seed(db, agents, workflows, audit):
+    """Seed agents, a script, workflows and audit rows; return the ids used by the benchmarks."""
+    db.create_token("bench-admin", ADMIN_TOKEN, "admin", "benchmark")
+    db.add_script("bench", os.path.join(CT_DIR, "tools", "bench.py"), "benchmark script", ["bench"], 1)
+    for i in range(agents):
+        db.register_or_update_agent("agent-%05d" % i, "10.0.%d.%d" % (i // 250, i % 250), 7614,
+                                    {"tags": ["bench"]}, metadata_for(i), "online")
+    ids = []
+    for i in range(workflows):
+        wid = "wf-%06d" % i
+        # High approval levels keep seeded workflows pending so approvals never run out.
+        db.create_workflow(wid, "bench", ["agent-%05d" % (i % max(agents, 1))], "bench",
+                           1000, "", 60, "benchmark")
+        ids.append(wid)
+    now = datetime.datetime.utcnow()
+    rows = []
+    for i in range(audit):
+        ts = (now - datetime.timedelta(seconds=audit - i)).isoformat() + "Z"
+        rows.append((ids[i % len(ids)] if ids else "wf-none", "note", "bench", ts, "row %d" % i))
+        if len(rows) >= 5000:
+            db.add_audit_many(rows)
+            rows = []
+    if rows:
+        db.add_audit_many(rows)
+    return ids
+
+def bench_db(db, args, wf_ids):
+    from controller.db.db import metadata_hash
+    n = args.iterations
+    names = ["agent-%05d" % i for i in range(max(args.agents, 1))]
+    wf = lambda i: wf_ids[i % len(wf_ids)]
+    now = lambda: datetime.datetime.utcnow().isoformat() + "Z"
+
+    def beats(i):
+        start = (i * 100) % len(names)
+        return [(name, "online", None, now(), None) for name in names[start:start + 100]]
+
+    def drain(it):
+        for _ in it:
+            pass
+
+    cases = {
+        "resolve_token": lambda i: db.resolve_token(ADMIN_TOKEN),
+        "resolve_principal": lambda i: db.resolve_principal(ADMIN_TOKEN),
+        "validate_token": lambda i: db.validate_token(ADMIN_TOKEN, ["admin"]),
+        "register_or_update_agent.noop": lambda i: db.register_or_update_agent(
+            names[i % len(names)], "10.0.%d.%d" % ((i % len(names)) // 250, (i % len(names)) % 250), 7614,
+            {"tags": ["bench"]}, metadata_for(i % len(names)), "online"),
+        "register_or_update_agent.changed": lambda i: db.register_or_update_agent(
+            names[i % len(names)], "10.1.0.1", 7614, {"tags": ["bench"]}, dict(metadata_for(i), seq=i), "online"),
+        "heartbeat_many.100": lambda i: db.heartbeat_many(beats(i)),
+        "heartbeat_many.100_metadata": lambda i: db.heartbeat_many(
+            [(b[0], b[1], json.dumps(metadata_for(i)), b[3], metadata_hash(metadata_for(i))) for b in beats(i)]),
+        "list_agents": lambda i: db.list_agents(),
+        "get_agents.50": lambda i: db.get_agents(names[:50]),
+        "list_scripts": lambda i: db.list_scripts(),
+        "get_script": lambda i: db.get_script("bench"),
+        "create_workflow": lambda i: db.create_workflow("bench-new-%d-%d" % (os.getpid(), time.perf_counter_ns()),
+                                                        "bench", names[:3], "bench", 1, "", 60, "bench"),
+        "get_workflow": lambda i: db.get_workflow(wf(i)),
+        "list_workflows.100": lambda i: db.list_workflows(100),
+        "list_workflows.100_status": lambda i: db.list_workflows(100, status=["pending"]),
+        "iter_workflows": lambda i: drain(db.iter_workflows()),
+        "count_workflows_by_status": lambda i: db.count_workflows_by_status(),
+        "approve_workflow": lambda i: db.approve_workflow(wf(i), "bench-approver-%d" % i),
+        "get_approvals": lambda i: db.get_approvals(wf(i)),
+        "add_audit": lambda i: db.add_audit(wf(i), "note", "bench", "bench"),
+        "add_audit_many.100": lambda i: db.add_audit_many([(wf(i), "note", "bench", now(), "b")] * 100),
+        "get_audit": lambda i: db.get_audit(wf(i)),
+        "iter_audit": lambda i: drain(db.iter_audit()),
+        "expire_due_workflows": lambda i: db.expire_due_workflows(),
+    }
+    # Whole-table scans get fewer iterations so a large seed stays quick.
+    scans = {"list_agents", "iter_workflows", "iter_audit"}
+    results = {}
+    for name, fn in cases.items():
+        if args.only and not any(name.startswith(p) for p in args.only):
+            continue
+        results[name] = measure(fn, max(1, n // 10) if name in scans else n)
+        print(f"  db {name:36s} {results[name]['p50_ms']:9.3f}ms p50 {results[name]['ops_per_s']:10.1f}/s",
+              file=sys.stderr)
+    return results
+
+def bench_http(args, wf_ids):
+    try:
+        from fastapi.testclient import TestClient
+    except ImportError as e:
+        print(f"❌ HTTP benchmarks skipped: {e}", file=sys.stderr)
+        return {}
+    from controller.controller import app
+    n = args.iterations
+    names = ["agent-%05d" % i for i in range(max(args.agents, 1))]
+    headers = {"x_admin_token": ADMIN_TOKEN}
+    # Approvals move workflows on, so give each one its own slice of ids.
+    approve_ids = wf_ids[len(wf_ids) // 2:] or wf_ids
+
+    def check(resp):
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{resp.status_code} {resp.text[:200]}")
+        return resp
+
+    results = {}
+    with TestClient(app) as client:
+        cases = {
+            "register": lambda i: check(client.post("/api/agents/register", headers=headers, json={
+                "agent_name": names[i % len(names)], "reg_secret": REG_SECRET, "port": 7614,
+                "capabilities": {"tags": ["bench"]}, "metadata": metadata_for(i % len(names))})),
+            "heartbeat": lambda i: check(client.post("/api/agents/heartbeat", headers=headers, json={
+                "agent_name": names[i % len(names)], "status": "online",
+                "metadata": metadata_for(i % len(names))})),
+            "list_agents": lambda i: check(client.get("/api/agents/", headers=headers)),
+            "list_workflows": lambda i: check(client.get("/api/workflows/", headers=headers,
+                                                         params={"limit": 100})),
+            "approve": lambda i: check(client.post("/api/workflows/%s/approve" % approve_ids[i % len(approve_ids)],
+                                                   headers=headers, json={"note": "bench"})),
+            "get_audit": lambda i: check(client.get("/api/workflows/%s/audit" % wf_ids[i % len(wf_ids)],
+                                                    headers=headers)),
+        }
+        for name, fn in cases.items():
+            if args.only and not any(name.startswith(p) for p in args.only):
+                continue
+            results[name] = measure(fn, n)
+            print(f"  http {name:34s} {results[name]['p50_ms']:9.3f}ms p50 {results[name]['ops_per_s']:10.1f}/s",
+                  file=sys.stderr)
+    return results
+
+def compare(current, baseline, max_regression):
+    """Return a list of 'group.name' entries whose p50 regressed beyond max_regression."""
+    regressions = []
+    for group in ("http", "db"):
+        for name, cur in current.get(group, {}).items():
+            base = baseline.get(group, {}).get(name)
+            if not base or not base.get("p50_ms"):
+                continue
+            change = cur["p50_ms"] / base["p50_ms"] - 1
+            cur["p50_change"] = round(change, 4)
+            if change > max_regression:
+                regressions.append(f"{group}.{name}: p50 {base['p50_ms']}ms -> {cur['p50_ms']}ms ({change:+.0%})")
+    return regressions
+
+def main():
+    # Controller modules print progress (migrations, route mounts) to stdout;
+    # keep stdout for the JSON results only.
+    args = parse_args()
+    with contextlib.redirect_stdout(sys.stderr):
+        results, regressions = run(args)
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    for line in regressions:
+        print(f"❌ regression {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmark the controller HTTP API and DB layer.")
+    ap.add_argument("--agents", type=int, default=500)
+    ap.add_argument("--workflows", type=int, default=2000)
+    ap.add_argument("--audit", type=int, default=20000)
+    ap.add_argument("--iterations", type=int, default=500, help="calls per benchmark")
+    ap.add_argument("--skip-http", action="store_true")
+    ap.add_argument("--skip-db", action="store_true")
+    ap.add_argument("--only", nargs="*", help="only run benchmarks whose name starts with one of these")
+    ap.add_argument("--out", help="write JSON results here instead of stdout")
+    ap.add_argument("--baseline", help="earlier results JSON to compare p50 latencies against")
+    ap.add_argument("--max-regression", type=float, default=0.25,
+                    help="fail when p50 is this fraction slower than the baseline")
+    ap.add_argument("--keep-db", action="store_true", help="leave the temporary DB on disk")
+    return ap.parse_args()
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix="ct-bench-")
+    # Must be set before controller modules are imported: they read env at import time.
+    os.environ["DB_FILE"] = os.path.join(tmp, "controller.db")
+    os.environ["ADMIN_TOKEN"] = ADMIN_TOKEN
+    os.environ["AGENT_REG_SECRET"] = REG_SECRET
+    from controller.db.db import get_db
+
+    db = get_db()
+    t0 = time.perf_counter()
+    wf_ids = seed(db, args.agents, args.workflows, args.audit)
+    seed_s = time.perf_counter() - t0
+    print(f"✅ seeded {args.agents} agents, {args.workflows} workflows, {args.audit} audit rows "
+          f"in {seed_s:.1f}s ({os.environ['DB_FILE']})", file=sys.stderr)
+
+    results = {
+        "meta": {
+            "ts": datetime.datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "agents": args.agents,
+            "workflows": args.workflows,
+            "audit": args.audit,
+            "iterations": args.iterations,
+            "seed_s": round(seed_s, 3),
+        },
+        # HTTP first: the DB benchmarks add rows and approvals that would skew it.
+        "http": {} if args.skip_http else bench_http(args, wf_ids),
+        "db": {} if args.skip_db else bench_db(db, args, wf_ids),
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        results["regressions"] = regressions
+
+    db.close()
+    if not args.keep_db:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results, regressions
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Simulated agent fleet: N agents registering and heartbeating against a
+running controller, from one process on one box.
+
+Start a controller, then from ct/:
+    ADMIN_TOKEN=... AGENT_REG_SECRET=... \\
+        python tools/fleet.py --url http://127.0.0.1:7604 --agents 5000 --duration 600 \\
+            --storm-every 120 --storm-fraction 0.3 --out fleet.json
+
+Every agent follows the real agent's schedule: a random splay, then a
+heartbeat every --interval seconds +/- --jitter, using the metadata delta
+protocol (or full metadata with --full-metadata). Restart storms make a
+fraction of the fleet drop its state and re-register at once.
+
+Every --report seconds one line is printed to stderr and a timeline entry
+recorded: client-side rate, p50/p99 and errors per call type, plus the
+controller's own view from /metrics (server-side p50/p99 per route, DB
+errors and SQLite lock errors in that window).
+"""
+import os, sys, json, time, random, string, asyncio, hashlib, argparse, datetime, re
+from collections import defaultdict
+import httpx
+
+def metadata_hash(metadata):
+    # Must match controller.db.db.metadata_hash.
+    canonical = json.dumps(metadata or {}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return round(ordered[k], 3)
+
+# ============================
+#  CONTROLLER METRICS
+# ============================
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def parse_metrics(text):
+    """Prometheus text -> {(name, frozenset(labels)): value}."""
+    out = {}
+    for line in text.splitlines():
+        m = _SAMPLE.match(line)
+        if not m:
+            continue
+        labels = frozenset(_LABEL.findall(m.group(2) or ""))
+        out[(m.group(1), labels)] = float(m.group(3))
+    return out
+
+def metric_delta(now, before, name, **match):
+    """Sum of name's samples (filtered on labels) that changed between two scrapes."""
+    total = 0.0
+    for (n, labels), value in now.items():
+        if n == name and all((k, v) in labels for k, v in match.items()):
+            total += value - before.get((n, labels), 0.0)
+    return total
+
+def histogram_quantile(now, before, name, q, **match):
+    """Approximate quantile (ms) of a histogram over the window between two scrapes."""
+    buckets = defaultdict(float)
+    for (n, labels), value in now.items():
+        if n != name + "_bucket" or not all((k, v) in labels for k, v in match.items()):
+            continue
+        le = dict(labels)["le"]
+        buckets[float("inf") if le == "+Inf" else float(le)] += value - before.get((n, labels), 0.0)
+    total = buckets.get(float("inf"), 0.0)
+    if total <= 0:
+        return None
+    for bound in sorted(buckets):
+        if buckets[bound] >= q * total:
+            return None if bound == float("inf") else round(bound * 1000, 3)
+    return None
+
+# ============================
+#  SIMULATED AGENTS
+# ============================
+
+class SimAgent:
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.name = "%s-%05d" % (fleet.args.prefix, index)
+        self.index = index
+        self.metadata = fleet.make_metadata(index)
+        self.acked = None
+        self.registered = False
+        self.restart = asyncio.Event()
+
+    async def run(self):
+        args = self.fleet.args
+        await self._sleep(random.uniform(0, args.interval) if args.splay else 0)
+        failures = 0
+        while not self.fleet.stopping:
+            ok = await (self.heartbeat() if self.registered else self.register())
+            failures = 0 if ok else failures + 1
+            if failures >= 3:
+                # Same as the real agent: assume the controller lost us.
+                self.registered = False
+            if failures:
+                delay = min(300, 2 * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+            else:
+                delay = args.interval * random.uniform(1 - args.jitter, 1 + args.jitter)
+            if await self._sleep(delay):
+                # Restarted: the process came back with no memory of what was acked.
+                self.registered = False
+                self.acked = None
+                await asyncio.sleep(random.uniform(0, args.storm_splay))
+
+    async def _sleep(self, seconds):
+        """Sleep, waking early on a restart. Returns True if restarted."""
+        try:
+            await asyncio.wait_for(self.restart.wait(), seconds)
+        except asyncio.TimeoutError:
+            return False
+        self.restart.clear()
+        return True
+
+    async def register(self):
+        args = self.fleet.args
+        payload = {
+            "agent_name": self.name,
+            "reg_secret": args.reg_secret,
+            "host": "10.%d.%d.%d" % (self.index // 65536 % 256, self.index // 256 % 256, self.index % 256),
+            "port": 7614,
+            "capabilities": {"tags": self.fleet.tags_for(self.index)},
+            "metadata": self.metadata,
+        }
+        reply = await self.fleet.call("register", "/api/agents/register", payload)
+        self.registered = reply is not None
+        self.acked = dict(self.metadata) if self.registered else None
+        return self.registered
+
+    async def heartbeat(self):
+        args = self.fleet.args
+        if random.random() < args.change_rate:
+            self.metadata = dict(self.metadata, loadavg=[round(random.uniform(0, 8), 2) for _ in range(3)])
+        payload = {"agent_name": self.name, "status": "online"}
+        if self.acked is None or args.full_metadata:
+            payload["metadata"] = self.metadata
+        else:
+            payload["metadata_hash"] = metadata_hash(self.metadata)
+            payload["metadata_delta"] = {k: v for k, v in self.metadata.items()
+                                         if k not in self.acked or self.acked[k] != v}
+            payload["metadata_removed"] = [k for k in self.acked if k not in self.metadata]
+        reply = await self.fleet.call("heartbeat", "/api/agents/heartbeat", payload)
+        if reply is None:
+            return False
+        self.acked = None if reply.get("resync") else dict(self.metadata)
+        return True
+
+class Fleet:
+    def __init__(self, args):
+        self.args = args
+        self.stopping = False
+        self.client = None
+        self.window = self._new_window()
+        self.totals = defaultdict(lambda: defaultdict(int))
+        self.timeline = []
+        self.agents = [SimAgent(self, i) for i in range(args.agents)]
+
+    @staticmethod
+    def _new_window():
+        return defaultdict(lambda: {"ok": 0, "errors": defaultdict(int), "latency_ms": []})
+
+    def make_metadata(self, index):
+        meta = {
+            "hostname": "%s-%05d.sim" % (self.args.prefix, index),
+            "platform": "Linux-5.15-x86_64-with-glibc2.35",
+            "python": "3.11.7",
+            "loadavg": [0.5, 0.4, 0.3],
+        }
+        # Pad to roughly --metadata-bytes of JSON with an inventory blob.
+        size = len(json.dumps(meta))
+        if self.args.metadata_bytes > size:
+            rnd = random.Random(index)
+            meta["inventory"] = "".join(rnd.choice(string.ascii_letters)
+                                        for _ in range(self.args.metadata_bytes - size - 16))
+        return meta
+
+    def tags_for(self, index):
+        return ["sim", "rack-%d" % (index % 20), "zone-%d" % (index % 3)]
+
+    async def call(self, kind, path, payload):
+        started = time.perf_counter()
+        error = None
+        try:
+            r = await self.client.post(path, json=payload)
+            if r.status_code != 200:
+                error = "http_%d" % r.status_code
+        except httpx.TimeoutException:
+            error = "timeout"
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        elapsed = (time.perf_counter() - started) * 1000
+        stats = self.window[kind]
+        if error:
+            stats["errors"][error] += 1
+            self.totals[kind]["errors"] += 1
+            return None
+        stats["ok"] += 1
+        stats["latency_ms"].append(elapsed)
+        self.totals[kind]["ok"] += 1
+        return r.json()
+
+    async def scrape(self):
+        try:
+            r = await self.client.get("/metrics")
+            return parse_metrics(r.text) if r.status_code == 200 else {}
+        except httpx.HTTPError:
+            return {}
+
+    async def storms(self):
+        args = self.args
+        while not self.stopping:
+            await asyncio.sleep(args.storm_every)
+            if self.stopping:
+                return
+            victims = random.sample(self.agents, int(len(self.agents) * args.storm_fraction))
+            print(f"⚠️ restart storm: {len(victims)} agents", file=sys.stderr)
+            self.timeline.append({"t": round(time.monotonic() - self.started, 1), "storm": len(victims)})
+            for agent in victims:
+                agent.restart.set()
+
+    async def report(self):
+        before = await self.scrape()
+        while not self.stopping:
+            await asyncio.sleep(self.args.report)
+            window, self.window = self.window, self._new_window()
+            now = await self.scrape()
+            entry = {"t": round(time.monotonic() - self.started, 1),
+                     "registered": sum(1 for a in self.agents if a.registered)}
+            for kind, route in (("register", "/api/agents/register"), ("heartbeat", "/api/agents/heartbeat")):
+                stats = window[kind]
+                calls = stats["ok"] + sum(stats["errors"].values())
+                entry[kind] = {
+                    "rate": round(calls / self.args.report, 1),
+                    "error_rate": round(sum(stats["errors"].values()) / calls, 4) if calls else 0.0,
+                    "errors": dict(stats["errors"]),
+                    "p50_ms": percentile(stats["latency_ms"], 50),
+                    "p99_ms": percentile(stats["latency_ms"], 99),
+                }
+                if now and before:
+                    name = "controller_http_request_duration_seconds"
+                    entry[kind]["server_p50_ms"] = histogram_quantile(now, before, name, 0.5,
+                                                                      method="POST", route=route)
+                    entry[kind]["server_p99_ms"] = histogram_quantile(now, before, name, 0.99,
+                                                                      method="POST", route=route)
+            if now and before:
+                entry["db_errors"] = metric_delta(now, before, "controller_db_call_errors_total")
+                entry["db_lock_errors"] = metric_delta(now, before, "controller_db_lock_errors_total")
+                entry["heartbeat_queue"] = now.get(("controller_queue_depth", frozenset({("queue", "heartbeats")})))
+            before = now or before
+            self.timeline.append(entry)
+            hb = entry["heartbeat"]
+            print(f"t={entry['t']:7.1f}s registered={entry['registered']:6d} "
+                  f"hb {hb['rate']:7.1f}/s p50={hb['p50_ms']}ms p99={hb['p99_ms']}ms err={hb['error_rate']:.2%} "
+                  f"reg {entry['register']['rate']:6.1f}/s "
+                  f"locks={entry.get('db_lock_errors', '?')}", file=sys.stderr)
+
+    async def run(self):
+        args = self.args
+        limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+        timeout = httpx.Timeout(args.timeout, connect=min(args.timeout, 5.0))
+        headers = {"x_admin_token": args.admin_token}
+        async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout, headers=headers) as client:
+            self.client = client
+            self.started = time.monotonic()
+            tasks = [asyncio.create_task(a.run()) for a in self.agents]
+            tasks.append(asyncio.create_task(self.report()))
+            if args.storm_every:
+                tasks.append(asyncio.create_task(self.storms()))
+            await asyncio.sleep(args.duration)
+            self.stopping = True
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return {
+            "meta": {
+                "ts": datetime.datetime.utcnow().isoformat() + "Z",
+                **{k: v for k, v in vars(args).items() if k not in ("admin_token", "reg_secret", "out")},
+            },
+            "totals": {k: dict(v) for k, v in self.totals.items()},
+            "timeline": self.timeline,
+        }
+
+def main():
+    ap = argparse.ArgumentParser(description="Simulate a fleet of agents against a local controller.")
+    ap.add_argument("--url", default=os.environ.get("API_BASE", "http://127.0.0.1:7604"))
+    ap.add_argument("--admin-token", default=os.environ.get("ADMIN_TOKEN", ""))
+    ap.add_argument("--reg-secret", default=os.environ.get("AGENT_REG_SECRET", ""))
+    ap.add_argument("--agents", type=int, default=1000)
+    ap.add_argument("--prefix", default="sim", help="agent name prefix")
+    ap.add_argument("--interval", type=float, default=float(os.environ.get("HEARTBEAT_INTERVAL", 30)))
+    ap.add_argument("--jitter", type=float, default=0.2, help="heartbeat jitter as a fraction of --interval")
+    ap.add_argument("--no-splay", dest="splay", action="store_false",
+                    help="start every agent at once instead of spreading them over one interval")
+    ap.add_argument("--metadata-bytes", type=int, default=512, help="approximate JSON size of agent metadata")
+    ap.add_argument("--change-rate", type=float, default=0.1, help="chance a heartbeat carries changed metadata")
+    ap.add_argument("--full-metadata", action="store_true", help="send full metadata on every heartbeat")
+    ap.add_argument("--storm-every", type=float, default=0, help="seconds between restart storms (0 = none)")
+    ap.add_argument("--storm-fraction", type=float, default=0.25, help="share of the fleet restarted per storm")
+    ap.add_argument("--storm-splay", type=float, default=1.0, help="seconds over which restarted agents come back")
+    ap.add_argument("--duration", type=float, default=300)
+    ap.add_argument("--report", type=float, default=10, help="seconds per timeline entry")
+    ap.add_argument("--connections", type=int, default=200, help="max concurrent HTTP connections")
+    ap.add_argument("--timeout", type=float, default=10)
+    ap.add_argument("--out", help="write the JSON report here instead of stdout")
+    args = ap.parse_args()
+
+    try:
+        result = asyncio.run(Fleet(args).run())
+    except KeyboardInterrupt:
+        return 130
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())